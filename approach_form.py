@@ -13,10 +13,12 @@ __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
 from PyQt5.QtWidgets import (
     QDialog, QVBoxLayout, QWidget, QButtonGroup,
-    QRadioButton, QPushButton, QLabel
+    QRadioButton, QPushButton, QLabel, QComboBox, QHBoxLayout
 )
 from PyQt5.QtCore import Qt
 from .utils.translations import _
+from .utils.geometry import AUTO_DETAIL
+from .create_layer import MEMORY_OUTPUT, DATABASE_OUTPUT, FILE_OUTPUT
 
 
 class ApproachForm(QDialog):
@@ -53,6 +55,28 @@ class ApproachForm(QDialog):
         self.radio_group.addButton(self.option1)
         self.radio_group.addButton(self.option2)
         
+        # Level of detail of the geometries, coarser levels are lighter for large areas
+        self.detail_label = QLabel(_("Geometry detail:"))
+        self.detail_combo = QComboBox()
+        self.detail_combo.addItem(_("Automatic"), AUTO_DETAIL)
+        self.detail_combo.addItem(_("Full"), 0)
+        self.detail_combo.addItem(_("Medium"), 1)
+        self.detail_combo.addItem(_("Low"), 2)
+        self.detail_combo.addItem(_("Very low"), 3)
+        detail_layout = QHBoxLayout()
+        detail_layout.addWidget(self.detail_label)
+        detail_layout.addWidget(self.detail_combo, 1)
+
+        # Where the layer keeps its geometries
+        self.output_label = QLabel(_("Layer storage:"))
+        self.output_combo = QComboBox()
+        self.output_combo.addItem(_("In memory"), MEMORY_OUTPUT)
+        self.output_combo.addItem(_("Read from the database"), DATABASE_OUTPUT)
+        self.output_combo.addItem(_("GeoPackage file"), FILE_OUTPUT)
+        output_layout = QHBoxLayout()
+        output_layout.addWidget(self.output_label)
+        output_layout.addWidget(self.output_combo, 1)
+
         # Next button to proceed to the next step
         self.button = QPushButton(_("Next"))
         self.button.setEnabled(False)  # Disabled until an option is selected
@@ -68,6 +92,8 @@ class ApproachForm(QDialog):
         layout.addWidget(self.option1)  # Add the first radio button
         layout.addWidget(self.option2)  # Add the second radio button
         layout.addStretch()  # Add more flexible space
+        layout.addLayout(detail_layout)  # Add the level of detail selection
+        layout.addLayout(output_layout)  # Add the layer storage selection
         layout.addWidget(self.button)  # Add the Next button
 
         # Set the main layout
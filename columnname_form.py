@@ -10,10 +10,9 @@
 ###############################################################################
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
-import sqlite3
 from PyQt5.QtWidgets import QDialog, QVBoxLayout, QPushButton, QLabel, QLineEdit
 from .utils.translations import _, gus_language
-from .config import DB_PATH
+from .utils.database import reader
 
 
 class ChooseColumnName(QDialog):
@@ -103,7 +102,7 @@ class ChooseColumnName(QDialog):
         Returns:
             str: A suggested column name based on the variable and subject metadata.
         """
-        with sqlite3.connect(DB_PATH) as conn:
+        with reader() as conn:
             cursor = conn.cursor()
 
             # Fetch variable details
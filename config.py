@@ -18,3 +18,12 @@ current_dir = os.path.dirname(os.path.realpath(__file__))
 DB_PATH = os.path.join(current_dir,DB_FILENAME)
 
 DATABASE_URL = "https://github.com/gospodarka-przestrzenna/QuickBDL/releases/download/database/data.sqlite"
+
+# Number of API requests kept in flight by the data fetching worker
+MAX_CONCURRENT_REQUESTS = 8
+
+# Local cache of API responses, kept next to the database
+CACHE_FILENAME = "cache.sqlite"
+CACHE_PATH = os.path.join(current_dir,CACHE_FILENAME)
+CACHE_TTL = 7 * 24 * 60 * 60  # seconds a cached response is used without asking the API
+CACHE_MAX_SIZE = 256 * 1024 * 1024  # bytes of compressed responses kept in the cache
@@ -11,28 +11,65 @@
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
 
-import sqlite3
 import binascii
+import os
 from .config import DB_PATH
-from qgis.core import QgsVectorLayer, QgsField, QgsGeometry, QgsFeature, QgsProject
+from .utils.database import reader
+from qgis.core import (
+    QgsVectorLayer, QgsField, QgsFields, QgsGeometry, QgsFeature, QgsProject, QgsVectorLayerJoinInfo,
+    QgsVectorFileWriter, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsCoordinateTransformContext
+)
 from qgis.PyQt.QtCore import QVariant
 from .utils.translations import _,gus_language
 from .utils.teryt import Teryt    
 
+BATCH_SIZE = 1000  # features added or updated in one provider call
+FILE_BATCH_SIZE = 50000  # features or values written to a GeoPackage file in one transaction
+FILE_LAYER_NAME = "gus_data"  # name of the layer inside a GeoPackage file
+
+# Where the layer keeps its geometries
+MEMORY_OUTPUT = "memory"  # copied into a memory layer
+DATABASE_OUTPUT = "database"  # read by OGR from the GeoPackage tables of data.sqlite, see spatial_layer
+FILE_OUTPUT = "file"  # written to a GeoPackage file chosen by the user
+
 class Layer(QgsVectorLayer):
     """
-    Represents a QGIS memory layer for managing territorial data.
+    Represents the QGIS layer of territorial data, kept in memory or written to a GeoPackage file.
     Includes methods for adding features, attributes, and processing geometry.
+    The layer is changed only from the GUI thread, features can be created anywhere.
     """
-    def __init__(self, layer_name):
+    def __init__(self, layer_name, years, output=MEMORY_OUTPUT, path=None):
         """
         Initializes the layer with default fields and configurations.
 
         Args:
             layer_name (str): The name of the memory layer.
+            years (list): Years selected by the user, columns are created only for them.
+            output (str): MEMORY_OUTPUT for a layer with geometries, DATABASE_OUTPUT for a table
+                of attributes joined to the geometries of the database by spatial_layer,
+                FILE_OUTPUT for a layer written to a GeoPackage file.
+            path (str): Path of the GeoPackage file of a FILE_OUTPUT layer, replaced if it exists.
         """
-        super().__init__("MultiPolygon?crs=EPSG:2180", layer_name, "memory")
+        if output == FILE_OUTPUT:
+            # an empty GeoPackage layer with a spatial index, the columns are added below
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = "GPKG"
+            options.layerName = FILE_LAYER_NAME
+            options.layerOptions = ["SPATIAL_INDEX=YES"]
+            writer = QgsVectorFileWriter.create(
+                path, QgsFields(), QgsWkbTypes.MultiPolygon,
+                QgsCoordinateReferenceSystem("EPSG:2180"), QgsCoordinateTransformContext(), options
+            )
+            if writer.hasError() != QgsVectorFileWriter.NoError:
+                raise ValueError(_("Cannot create the file {path}: {error}").format(path=path, error=writer.errorMessage()))
+            del writer  # closes the file
+            super().__init__(f"{path}|layername={FILE_LAYER_NAME}", layer_name, "ogr")
+        else:
+            geometry_type = "MultiPolygon?crs=EPSG:2180" if output == MEMORY_OUTPUT else "None"
+            super().__init__(geometry_type, layer_name, "memory")
         self.provider = self.dataProvider()
+        self.output = output
+        self.path = path
 
         # Index to map long unit codes to their corresponding features
         self.feature_index = {}  # {long_code: QgsFeature}
@@ -43,6 +80,9 @@ class Layer(QgsVectorLayer):
             "type": 1,
             "name": 2
         }
+        if output == FILE_OUTPUT:
+            # the GeoPackage provider shows the feature id as the first column
+            self.column_index = {"fid": 0, **{name: index + 1 for name, index in self.column_index.items()}}
 
         # Add default attributes to the layer
         self.provider.addAttributes([
@@ -50,80 +90,223 @@ class Layer(QgsVectorLayer):
             QgsField(_("type"), QVariant.String),
             QgsField(_("name"), QVariant.String)
         ])
+        if output == DATABASE_OUTPUT:
+            # key of the join, short code and kind
+            self.column_index["unit"] = 3
+            self.provider.addAttributes([QgsField("unit", QVariant.String)])
         self.updateFields()
 
-        # Tracks years and their corresponding column indices
-        self.year_columns = {}
+        # Years for which columns are created
+        self.years = {str(year) for year in years}
+
+        # Value columns declared by declare_columns and the ones that got a value
+        self.value_columns = {}  # {(variable_id, year): column index}
+        self.filled_columns = set()
+
+        # Features and values waiting to be written in one provider call, see flush
+        self.batch_size = FILE_BATCH_SIZE if output == FILE_OUTPUT else BATCH_SIZE
+        self.pending_features = []  # [(full_code, QgsFeature, do_merge)]
+        self.pending_changes = {}  # {feature id: {column index: value}}
+
+    @staticmethod
+    def index_codes(full_code, do_merge):
+        """
+        Returns the unit codes under which the feature of a unit is indexed. In merge mode
+        the urban-rural commune also stands for its city and rural area.
+
+        Args:
+            full_code (str): The full unit code.
+            do_merge (bool): Whether to merge rural and urban areas into a single unit.
+
+        Returns:
+            list: Unit codes of the feature index.
+        """
+        if do_merge and full_code[-1] == '3':
+            return [full_code[:-1]+'1', full_code[:-1]+'2', full_code]
+        return [full_code]
 
-    def create_new_feature(self, full_code, name, geometry, do_merge):
+    @staticmethod
+    def new_feature(full_code, name, geometry):
         """
-        Creates a new feature for the specified unit and adds it to the layer.
-        
+        Creates a feature for the specified unit, not yet added to any layer.
+        Can be called from any thread, the feature is added with add_features.
+
         Args:
             full_code (str): The full unit code.
             name (str): The name of the unit.
             geometry (QgsGeometry): The geometry of the unit.
-            do_merge (bool): Whether to merge rural and urban areas into a single unit.
 
         Returns:
-            bool: True if the feature was created successfully, False otherwise.
+            QgsFeature: The new feature.
         """
         shorter_code = full_code[2:4] + full_code[7:11]
         kind = full_code[11]
-        if name is None:
-            None
-        if geometry is None:
-            None
-        
-        # Create a new feature and set its attributes
+
         feature = QgsFeature()
         feature.setGeometry(geometry)
         feature.setAttributes([shorter_code, kind, name])
+        return feature
 
-        # Add the feature to the provider
-        self.provider.addFeature(feature)
+    def add_features(self, features, do_merge):
+        """
+        Queues a batch of features and writes the queued ones once there are batch_size
+        of them, each provider call is one transaction of a file.
 
-        # Update the feature index to quick insert data when obtained from 
-        if do_merge and full_code[-1] == '3':
-            self.feature_index[full_code[:-1]+'1'] = feature
-            self.feature_index[full_code[:-1]+'2'] = feature
-        
-        self.feature_index[full_code] = feature
-        return True
+        Args:
+            features (list): Tuples (full_code, QgsFeature) created by new_feature.
+            do_merge (bool): Whether to merge rural and urban areas into a single unit.
+        """
+        for full_code, feature in features:
+            if self.output == DATABASE_OUTPUT:
+                feature.setAttributes(feature.attributes() + [full_code[2:4] + full_code[7:11] + full_code[11]])
+            elif self.output == FILE_OUTPUT:
+                feature.setAttributes([None] + feature.attributes())  # the feature id is assigned by the file
+            self.pending_features.append((full_code, feature, do_merge))
+        if len(self.pending_features) >= self.batch_size:
+            self.write_features()
+
+    def write_features(self):
+        """
+        Adds the queued features to the provider and indexes the added features,
+        which carry their ids, by unit code.
+        """
+        features, self.pending_features = self.pending_features, []
+        for start in range(0, len(features), self.batch_size):
+            batch = features[start:start + self.batch_size]
+            _ok, added = self.provider.addFeatures([feature for _code, feature, _merge in batch])
+            for (full_code, _queued, do_merge), feature in zip(batch, added):
+                for code in Layer.index_codes(full_code, do_merge):
+                    self.feature_index[code] = feature
+        if features:
+            self.updateExtents()
+
+    def declare_columns(self, variables, years, variables_names):
+        """
+        Creates a column for every variable and year at once, in the order of the variables
+        and years, before any value arrives. Columns left without values are removed
+        by drop_empty_columns.
+
+        Args:
+            variables (list): Variable IDs, in the order of the columns.
+            years (list): Years, in the order of the columns.
+            variables_names (dict): Mapping of variable IDs to their user-defined column names.
+        """
+        new_fields = []
+        for variable_id in variables:
+            for year in years:
+                column = f"{variables_names[variable_id]} ({year})"
+                if column not in self.column_index:
+                    self.column_index[column] = len(self.column_index)
+                    new_fields.append(QgsField(column, QVariant.Double))
+                self.value_columns[(str(variable_id), str(year))] = self.column_index[column]
+        self.provider.addAttributes(new_fields)
+        self.updateFields()
 
-    def add_GUS_data(self, unit_id, year, value, column_prefix):
+    def apply_cells(self, cells):
         """
-        Adds data for a specific unit and year to the layer.
+        Queues a batch of values and writes the queued ones once they are set for batch_size
+        features, with one changeAttributeValues call. Values of columns that were not
+        declared are ignored.
 
         Args:
-            unit_id (str): The unit identifier.
-            year (str): The year for the data.
-            value (float): The value to add.
-            column_prefix (str): Prefix for the column name.
-            get_geom_n_type (function): Geometry and type retrieval function.
+            cells (list): Tuples (unit_id, variable_id, year, value) for units of the feature index.
+        """
+        # values need the ids of the features
+        self.write_features()
+        for unit_id, variable_id, year, value in cells:
+            index = self.value_columns.get((variable_id, year))
+            feature = self.feature_index.get(unit_id)
+            if index is None or feature is None:
+                continue
+            self.pending_changes.setdefault(feature.id(), {})[index] = float(value)
+            self.filled_columns.add(index)
+        if len(self.pending_changes) >= self.batch_size:
+            self.write_changes()
+
+    def write_changes(self):
+        """
+        Writes the queued values to the provider.
+        """
+        changes, self.pending_changes = self.pending_changes, {}
+        feature_ids = list(changes)
+        for start in range(0, len(feature_ids), self.batch_size):
+            self.provider.changeAttributeValues({
+                feature_id: changes[feature_id]
+                for feature_id in feature_ids[start:start + self.batch_size]
+            })
+
+    def finish(self):
+        """
+        Writes everything still queued and removes the columns without values,
+        called after the last batch.
         """
-        year = str(year)
+        self.write_features()
+        self.write_changes()
+        self.drop_empty_columns()
 
-        if unit_id not in self.feature_index:
+    def drop_empty_columns(self):
+        """
+        Removes the declared value columns that did not get any value.
+        """
+        empty = sorted(set(self.value_columns.values()) - self.filled_columns)
+        if not empty:
             return
+        self.provider.deleteAttributes(empty)
+        self.updateFields()
+
+        # indices of the remaining columns shift after the deletion
+        names = [name for name, _index in sorted(self.column_index.items(), key=lambda column: column[1])]
+        names = [name for index, name in enumerate(names) if index not in empty]
+        self.column_index = {name: index for index, name in enumerate(names)}
+        self.value_columns = {}
+        self.filled_columns = set(range(len(names)))
 
-        if year not in self.year_columns:
-            self.year_columns[year] = []
+    def spatial_layer(self, table):
+        """
+        Creates the layer shown in the project for a DATABASE_OUTPUT layer. Geometries are read
+        by OGR from a GeoPackage table of data.sqlite, limited to the units of this layer,
+        and the name and value columns of this layer are joined to them by unit.
+        This layer has to stay in the project, without a legend entry, for the join.
 
-        column = f"{column_prefix} ({year})"
-        if column not in self.column_index:
-            self.column_index[column] = len(self.column_index)
-            self.provider.addAttributes([QgsField(column, QVariant.Double)])
-            self.updateFields()
+        Args:
+            table (str): Name of the GeoPackage feature table, see GeoPackage.table.
 
-            for feature in self.feature_index.values():
-                feature.resizeAttributes(len(self.column_index))
-                self.provider.changeAttributeValues({feature.id(): {self.column_index[column]: value}})
+        Returns:
+            QgsVectorLayer: The read-only OGR layer with the joined attributes.
+        """
+        layer = QgsVectorLayer(f"{DB_PATH}|layername={table}", self.name(), "ogr")
+        units = {feature["unit"] for feature in self.getFeatures()}
+        if units:
+            layer.setSubsetString('"unit" IN ({})'.format(", ".join(f"'{unit}'" for unit in sorted(units))))
+        else:
+            # an empty IN list is not valid SQL, a layer without units shows no geometries
+            layer.setSubsetString("0 = 1")
+        layer.setReadOnly(True)
 
-        self.year_columns[year].append(self.column_index[column])
-        feature = self.feature_index[unit_id]
-        self.provider.changeAttributeValues({feature.id(): {self.column_index[column]: value}})
+        keys = {self.column_index[name] for name in ("short_code", "type", "unit")}
+        join = QgsVectorLayerJoinInfo()
+        join.setJoinLayer(self)
+        join.setJoinFieldName("unit")
+        join.setTargetFieldName("unit")
+        join.setUsingMemoryCache(True)
+        join.setPrefix("")
+        join.setJoinFieldNamesSubset([field.name() for index, field in enumerate(self.fields()) if index not in keys])
+        layer.addJoin(join)
+        return layer
 
+    def discard(self):
+        """
+        Deletes the GeoPackage file of a FILE_OUTPUT layer whose fetching failed or was cancelled,
+        so no half-written file is left behind. A resumed job creates the file again.
+        """
+        if self.output != FILE_OUTPUT:
+            return
+        for path in (self.path, self.path + "-wal", self.path + "-shm"):
+            try:
+                os.remove(path)
+            except OSError:
+                # already removed, or still held open by a system that does not allow removing it
+                pass
 
     def get_name(self, short_code, type):
         """
@@ -136,7 +319,7 @@ class Layer(QgsVectorLayer):
         Returns:
             str: The name of the unit.
         """
-        with sqlite3.connect(DB_PATH) as conn:
+        with reader() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT name
@@ -147,22 +330,3 @@ class Layer(QgsVectorLayer):
             if not result:
                 raise ValueError(_("Name not found for code: {short_code} {type}").format(short_code=short_code, type=type))
             return result[0]
-
-    def remove_unwanted_years_columns(self, years):
-        """
-        Removes columns corresponding to unwanted years.
-
-        Args:
-            years (list): List of years to retain.
-        """
-        to_delete = []
-        for year, columns in self.year_columns.items():
-            if year not in years:
-                to_delete.extend(columns)
-
-        self.year_columns = {year: columns for year, columns in self.year_columns.items() if year in years}
-        self.provider.deleteAttributes(to_delete)
-        self.updateFields()
-
-        # Rebuild column index after deletion
-        self.column_index = {field.name(): index for index, field in enumerate(self.fields())}
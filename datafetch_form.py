@@ -15,6 +15,8 @@ from PyQt5.QtWidgets import QDialog, QVBoxLayout, QPushButton, QLabel, QProgress
 from PyQt5.QtCore import Qt
 from .datafetch_worker import DataFetchWorker
 from .utils.translations import _
+from .utils.geometry import AUTO_DETAIL
+from .create_layer import MEMORY_OUTPUT
 from .config import DB_PATH
 
 class DataFetchForm(QDialog):
@@ -26,19 +28,35 @@ class DataFetchForm(QDialog):
         units (list): List of selected territorial units.
         variables (list): List of selected variables.
         variables_names (dict): Mapping of variable IDs to user-defined column names.
+        years (list): Years to fetch.
+        job_id (int): ID of an unfinished fetch job to resume, None starts a new one.
+        detail (int): Level of detail of the geometries, AUTO_DETAIL picks it automatically.
+        output (str): Where the layer keeps its geometries, see create_layer.
+        path (str): Path of the GeoPackage file of a FILE_OUTPUT layer.
     """
-    def __init__(self, do_merge, units, variables, variables_names):
+    def __init__(self, do_merge, units, variables, variables_names, years, job_id=None, detail=AUTO_DETAIL, output=MEMORY_OUTPUT, path=None):
         super().__init__()
 
         self.do_merge = do_merge
         self.units = units
         self.variables = variables
         self.variables_names = variables_names
+        self.years = years
+        self.job_id = job_id
+        self.detail = detail
+        self.output = output
+        self.path = path
         self.layer = None  # Placeholder for the resulting layer
+        self.worker = None  # Created when the dialog is shown
 
         # Configure the main dialog window
         self.setWindowTitle(_("Data Fetching"))
-        self.resize(600, 150)
+        self.resize(600, 180)
+
+        # Progress bar to display the loading of unit names and geometries
+        self.units_progress_bar = QProgressBar()
+        self.units_progress_bar.setAlignment(Qt.AlignCenter)
+        self.units_progress_bar.setFormat(_("Loading units: %p%"))
 
         # Progress bar to display the download progress
         self.progress_bar = QProgressBar()
@@ -55,6 +73,7 @@ class DataFetchForm(QDialog):
 
         # Main layout
         layout = QVBoxLayout()
+        layout.addWidget(self.units_progress_bar)
         layout.addWidget(self.progress_bar)
         layout.addWidget(self.message_label)
         layout.addWidget(self.button)
@@ -65,19 +84,52 @@ class DataFetchForm(QDialog):
         """
         Called when the dialog is shown. Initializes and starts the data fetching worker thread.
         """
-        self.worker = DataFetchWorker(
-            self.do_merge,
-            self.units, 
-            self.variables, 
-            self.variables_names
-        )
+        try:
+            self.worker = DataFetchWorker(
+                self.do_merge,
+                self.units, 
+                self.variables, 
+                self.variables_names,
+                self.years,
+                self.job_id,
+                self.detail,
+                self.output,
+                self.path
+            )
+        except ValueError as e:
+            # the output file could not be created
+            self.worker = None
+            self.on_error(str(e))
+            return
         # Connect worker signals
         self.worker.progress_updated.connect(self.update_progress)
+        self.worker.units_progress.connect(self.update_units_progress)
+        self.worker.geometries_progress.connect(self.update_geometries_progress)
         self.worker.data_fetched.connect(self.on_data_fetched)
         self.worker.error_occurred.connect(self.on_error)
         # Start the worker thread
         self.worker.start()
 
+    def update_geometries_progress(self, value):
+        """
+        Shows the progress of building the full resolution geometries in the units progress bar.
+
+        Args:
+            value (int): Percentage of completion.
+        """
+        self.units_progress_bar.setFormat(_("Preparing geometries: %p%"))
+        self.units_progress_bar.setValue(value)
+
+    def update_units_progress(self, value):
+        """
+        Updates the progress bar of loading unit names and geometries.
+
+        Args:
+            value (int): Percentage of completion.
+        """
+        self.units_progress_bar.setFormat(_("Loading units: %p%"))
+        self.units_progress_bar.setValue(value)
+
     def update_progress(self, value, unit, variable):
         """
         Updates the progress bar and status label.
@@ -100,7 +152,12 @@ class DataFetchForm(QDialog):
         Called when data fetching is completed successfully.
         Updates the status label and enables the button to proceed.
         """
-        self.message_label.setText(_("Data fetching completed successfully."))
+        message = _("Data fetching completed successfully.")
+        if self.worker.saved_requests > 0:
+            message += " " + _("{saved} requests saved by querying common parent units.").format(
+                saved=self.worker.saved_requests
+            )
+        self.message_label.setText(message)
         self.layer = self.worker.layer
         self.button.setText(_("Next"))
         self.button.setEnabled(True)
@@ -117,7 +174,26 @@ class DataFetchForm(QDialog):
         self.button.clicked.connect(self.close)
         self.button.setText(_("Close"))
         self.button.setEnabled(True)
-        self.worker.quit()
+        if self.worker is not None:
+            self.worker.quit()
+            self.discard_output()
+
+    def discard_output(self):
+        """
+        Stops the worker and deletes the unfinished output file once the worker stopped writing it.
+        """
+        self.worker.cancel()
+        self.worker.finished.connect(self.worker.layer.discard)
+        if not self.worker.isRunning():
+            self.worker.layer.discard()
+
+    def reject(self):
+        """
+        Cancels the fetching when the dialog is closed before it finished.
+        """
+        if self.worker is not None and self.layer is None:
+            self.discard_output()
+        super().reject()
 
     def closeEvent(self, event):
         """
@@ -11,15 +11,42 @@
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
 
-import sqlite3
+import json
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtCore import Qt, pyqtSignal, QThread
-from .create_layer import Layer
-from .utils.translations import _
-from .config import DB_PATH
+from qgis.core import Qgis, QgsMessageLog
+from .create_layer import Layer, MEMORY_OUTPUT, DATABASE_OUTPUT
+from .utils.translations import _, gus_language
+from .config import DB_PATH, MAX_CONCURRENT_REQUESTS
 import requests
-import time
 from .utils.expander import Expander
-from .utils.tokens import Tokens
+from .utils.geometry import AUTO_DETAIL, FULL_DETAIL, Geometry, auto_detail
+from .utils.geopackage import GeoPackage
+from .utils.tokens import TokenPool
+from .utils.client import BDLClient
+from .utils.response_cache import ResponseCache
+from .utils.planner import RequestPlanner, BY_VARIABLE, PAGE_SIZE
+from .utils.cells import CellFilter
+from .utils.jobs import FetchJob
+from .utils.pipeline import StageCounters, STOP, put
+
+API_DATA_URL = "https://bdl.stat.gov.pl/api/v1/data"
+UNIT_LEVEL = 6  # data is always fetched for the finest units
+APPLY_QUEUE_SIZE = 16  # batches of features or cells waiting for the layer
+UNITS_BATCH_SIZE = 100  # features handed over to the layer at once
+
+# Kinds of batches in the apply queue
+FEATURES = "features"
+VALUES = "values"
+UNITS_LOADED = "units_loaded"  # after the last batch of features
+
+# Payload of a page that could not be fetched because no token was left
+NO_TOKENS = "no_tokens"
+
 class DataFetchWorker(QThread):
     """
     Worker thread for fetching data from the API. Handles progress updates, error handling,
@@ -27,9 +54,12 @@ class DataFetchWorker(QThread):
     """
     progress_updated = pyqtSignal(int, str, str)  # Signal for progress updates (progress, unit, variable)
     data_fetched = pyqtSignal()  # Signal emitted after data fetching is complete
+    batch_ready = pyqtSignal()  # Signal emitted when a batch waits in the apply queue
+    units_progress = pyqtSignal(int)  # Signal for progress of loading unit names and geometries
+    geometries_progress = pyqtSignal(int)  # Signal for progress of building the full resolution geometry table
     error_occurred = pyqtSignal(str)  # Signal emitted when an error occurs
 
-    def __init__(self, do_merge, units, variables, variables_names):
+    def __init__(self, do_merge, units, variables, variables_names, years, job_id=None, detail=AUTO_DETAIL, output=MEMORY_OUTPUT, path=None, concurrency=MAX_CONCURRENT_REQUESTS):
         """
         Initialize the worker.
 
@@ -38,112 +68,392 @@ class DataFetchWorker(QThread):
             units (list): List of unit codes to fetch data for.
             variables (list): List of variable IDs to fetch data for.
             variables_names (dict): Mapping of variable IDs to their user-defined column names.
+            years (list): Years to fetch, passed to the API as the year filter.
+            job_id (int): ID of an unfinished fetch job to resume, None starts a new job.
+            detail (int): Level of detail of the geometries, AUTO_DETAIL picks it from the number of units.
+            output (str): Where the layer keeps its geometries, MEMORY_OUTPUT, DATABASE_OUTPUT or FILE_OUTPUT.
+            path (str): Path of the GeoPackage file of a FILE_OUTPUT layer.
+            concurrency (int): Maximum number of API requests kept in flight at once.
         """
         super().__init__()
         
         # Create a new layer to store fetched data
-        self.layer = Layer(_("GUS data layer"))
+        self.layer = Layer(_("GUS data layer"), years, output, path)
 
         self.do_merge = do_merge
         self.units = units
         self.variables = variables
         self.variables_names = variables_names        
+        self.years = sorted(str(year) for year in years)
+        self.concurrency = max(1, int(concurrency))
+        self.job_id = job_id
+        self.detail = detail
+        self.output = output
+        self.path = path
+
+        # GeoPackage table the geometries of a DATABASE_OUTPUT layer are read from, set in run()
+        self.table = None
+
+        # Set when the fetching has to stop, checked by the requests still in flight
+        self.aborted = False
+
+        # Requests avoided by querying common parents of the selected units
+        self.saved_requests = 0
 
-        for full_code,name,geometry in Expander().codes_name_geometry(self.units,do_merge):
-            self.layer.create_new_feature(full_code,name,geometry,do_merge)
+        # Codes of the finest units, expanded in run() and used to plan the requests
+        self.leaf_codes = []
+        self.layer.declare_columns(self.variables, self.years, self.variables_names)
+
+        # Stages of the pipeline: units and fetch threads -> decode (this thread) -> apply (GUI thread)
+        self.decode_queue = queue.Queue(maxsize=2 * self.concurrency)
+        self.apply_queue = queue.Queue(maxsize=APPLY_QUEUE_SIZE)
+        # Throughput and backpressure of each stage, logged when the fetching is done
+        self.stages = {name: StageCounters(name) for name in ("units", "fetch", "decode", "apply")}
+        self.units_thread = None
+
+        # Values that came before all features were added, applied with the last batch of features
+        self.units_loaded = False
+        self.early_cells = []
+
+        # The worker object lives in the GUI thread, so the applier runs there
+        self.batch_ready.connect(self.apply_batches)
 
     def run(self):
         """
-        Main execution function for the worker thread. Handles data fetching and
-        updates the progress accordingly.
+        Main execution function for the worker thread, the decode stage of the pipeline.
+        Fetch threads keep up to `concurrency` page requests in flight and hand the pages over
+        through a bounded queue. Here the pages are decoded, normalised into cells and merged
+        in the fixed order of the plan so the outcome does not depend on timing. Every merged
+        request is checkpointed in the fetch job, so an interrupted run can be resumed without
+        sending it again, and its cells go to the applier on the GUI thread through another
+        bounded queue. Full queues block the stage before them.
         """
-        total_requests = 2 * len(self.units) * len(self.variables)
-        completed_requests = 0
-        
-        for variable in self.variables:
-            for unit in self.units:
-                # Update progress before each request
-                completed_requests += 1
-                progress = int((completed_requests / total_requests) * 100)
-                self.progress_updated.emit(progress, unit, variable)
-
-                # Fetch data for the current variable-unit pair
-                success = self.fetch_data(variable, unit)
-                if not success:
+        # Expand the selection, names and geometries are loaded alongside the first requests
+        self.leaf_codes = Expander().expand_codes(self.units, self.do_merge)
+        detail = auto_detail(len(self.leaf_codes)) if self.detail is AUTO_DETAIL else self.detail
+        if not Geometry().has_level(detail):
+            # a database built without the simplified geometries
+            detail = FULL_DETAIL
+        if self.output == DATABASE_OUTPUT:
+            self.table = GeoPackage().table(detail)
+            if self.table is None:
+                # the full resolution table is not shipped, it is built once from the arcs
+                self.table = GeoPackage().build_full_detail(self.geometries_progress.emit, lambda: self.aborted)
+                if self.table is None:
+                    return
+        self.units_thread = threading.Thread(target=self.load_units, args=(self.leaf_codes, detail), daemon=True)
+        self.units_thread.start()
+
+        # Only the values for units of the layer are stored and applied
+        unit_ids = [code for full_code in self.leaf_codes for code in Layer.index_codes(full_code, self.do_merge)]
+        self.cells = CellFilter(unit_ids, self.variables, self.years)
+
+        # Work items in the order their results are merged into the layer
+        if self.job_id is None:
+            planner = RequestPlanner(self.units, self.variables, self.leaf_codes)
+            work_items = planner.plan()
+            self.saved_requests = planner.saved_requests
+            job = FetchJob.create(
+                self.do_merge, self.units, self.variables, self.variables_names, self.years, work_items,
+                self.detail, self.output, self.path
+            )
+            completed_items = set()
+        else:
+            job = FetchJob(self.job_id)
+            work_items = job.items()
+            completed_items = job.completed_items()
+            # values merged in an earlier run go to the layer first
+            self.apply(self.cells.filter(job.values()))
+
+        pages = {index: {} for index in range(len(work_items))}  # {item index: {page: cells}}
+        page_counts = {}  # {item index: number of pages}, known after the first page
+        next_to_merge = 0
+
+        total_pages = len(work_items)  # grows as page counts become known
+        completed_pages = len(completed_items)
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        futures = []
+        outstanding = 0  # pages submitted to the fetch stage and not decoded yet
+
+        def submit(index, page):
+            nonlocal outstanding
+            futures.append(executor.submit(self.fetch_stage, index, work_items[index], page))
+            outstanding += 1
+
+        try:
+            for index in range(len(work_items)):
+                if index not in completed_items:
+                    submit(index, 0)
+
+            while outstanding:
+                index, page, payload = self.decode_queue.get()
+                outstanding -= 1
+                if self.aborted:
+                    # cancelled by the user, the job stays to be resumed
+                    self.abort(futures)
+                    return
+                if payload is NO_TOKENS:
+                    self.abort(futures)
+                    self.error_occurred.emit(_("No available tokens. D2"))
+                    return
+                if payload is None:
+                    self.abort(futures)
                     self.error_occurred.emit(_("Error while fetching data. D1"))
                     return
 
-                # Update progress after successful fetch
-                completed_requests += 1
-                progress = int((completed_requests / total_requests) * 100)
-                self.progress_updated.emit(progress, unit, variable)
-        
-        # Emit signal once all data is fetched
+                start = time.monotonic()
+                data = json.loads(payload) if isinstance(payload, bytes) else payload
+                pages[index][page] = self.process_response(data)
+                completed_pages += 1
+
+                if page == 0 and "totalRecords" in data:
+                    # The first page tells how many pages there are, request the rest at once
+                    page_counts[index] = max(1, math.ceil(data["totalRecords"] / PAGE_SIZE))
+                    for next_page in range(1, page_counts[index]):
+                        submit(index, next_page)
+                    total_pages += page_counts[index] - 1
+                elif "totalRecords" not in data:
+                    # Without the record count follow the "next" links one page at a time
+                    if "links" in data and "next" in data["links"]:
+                        submit(index, page + 1)
+                        total_pages += 1
+                    else:
+                        page_counts[index] = page + 1
+                self.stages["decode"].processed(1, time.monotonic() - start)
+
+                _endpoint, unit, variables = work_items[index]
+                progress = int((completed_pages / total_pages) * 100)
+                self.progress_updated.emit(progress, unit, ", ".join(variables))
+
+                # Merge every work item that is complete, keeping the fixed order
+                while next_to_merge < len(work_items):
+                    if next_to_merge in completed_items:
+                        # merged in an earlier run, its values came from the job
+                        next_to_merge += 1
+                        continue
+                    if next_to_merge not in page_counts or len(pages[next_to_merge]) < page_counts[next_to_merge]:
+                        break
+                    cells = []
+                    for item_page in range(page_counts[next_to_merge]):
+                        cells.extend(pages[next_to_merge][item_page])
+                    stored = self.cells.filter(cells)
+                    job.complete_item(next_to_merge, stored)
+                    del pages[next_to_merge]
+                    next_to_merge += 1
+                    self.apply(stored)
+        finally:
+            executor.shutdown(wait=True)
+            TokenPool.instance().flush()
+            ResponseCache.instance().flush()
+
+        self.units_thread.join()
+        put(self.apply_queue, STOP, self.stages["decode"], lambda: self.aborted)
+        self.batch_ready.emit()
+        job.finish()
+        QgsMessageLog.logMessage("; ".join(str(stage) for stage in self.stages.values()), "QuickBDL", Qgis.Info)
+
+        # Emit signal once all data is fetched, the applier handled the batches before
         self.data_fetched.emit()
 
-    def fetch_data(self, variable, unit):
+    def load_units(self, leaf_codes, detail):
         """
-        Fetch data from the API for a specific variable and unit, handling pagination.
+        The units stage of the pipeline, running in its own thread. Loads names and geometries
+        of the units, creates their features and hands them over to the applier in batches,
+        reporting its progress with units_progress.
 
         Args:
-            variable (str): The variable ID to fetch data for.
-            unit (str): The unit code to fetch data for.
+            leaf_codes (list): Full codes of the units of the layer.
+            detail (int): Level of detail of the geometries.
+        """
+        total = len(leaf_codes)
+        batch = []
+        start = time.monotonic()
+        if self.output == DATABASE_OUTPUT:
+            units = Expander().names(leaf_codes)  # geometries stay in the database
+        else:
+            units = Expander().names_geometries(leaf_codes, level=detail)
+        for done, (full_code, name, geometry) in enumerate(units, 1):
+            if self.aborted:
+                return
+            batch.append((full_code, Layer.new_feature(full_code, name, geometry)))
+            if len(batch) < UNITS_BATCH_SIZE and done < total:
+                continue
+            self.stages["units"].processed(len(batch), time.monotonic() - start)
+            if not put(self.apply_queue, (FEATURES, batch), self.stages["units"], lambda: self.aborted):
+                return
+            self.batch_ready.emit()
+            self.units_progress.emit(int(done / total * 100))
+            batch = []
+            start = time.monotonic()
+        if put(self.apply_queue, (UNITS_LOADED, []), self.stages["units"], lambda: self.aborted):
+            self.batch_ready.emit()
 
-        Returns:
-            bool: True if the data was fetched successfully, False otherwise.
+    def apply(self, cells):
+        """
+        Hands a batch of cells over to the applier on the GUI thread.
+        Blocks while the applier is behind by APPLY_QUEUE_SIZE batches.
+        """
+        if not cells:
+            return
+        if put(self.apply_queue, (VALUES, cells), self.stages["decode"], lambda: self.aborted):
+            self.batch_ready.emit()
+
+    def apply_batches(self):
+        """
+        The apply stage of the pipeline, running on the GUI thread that owns the layer.
+        Adds every queued batch of features or values to the layer, and after the last batch
+        writes what the layer still queues and removes the columns without values.
+        Values coming before the last batch of features are held back until it was added,
+        so the features they belong to exist.
         """
-        page = 0
         while True:
-            # Get a valid token for the request
-            token = Tokens().get_random_token()
-            if not token:
-                self.error_occurred.emit(_("No available tokens. D2"))
-                return False
-            
-            url = f"https://bdl.stat.gov.pl/api/v1/data/by-variable/{variable}"
-            params = {
-                "unit-parent-id": unit,
-                "unit-level": 6,
-                "page": page,
-                "page-size": 100
-            }
-            headers = {"X-ClientId": token}
-
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code == 200:
-                data = response.json()
-                self.process_response(data)
-                # Stop if there's no next page
-                if "links" not in data or "next" not in data["links"]:
-                    break
-                
-                page += 1
-                time.sleep(1)  # Rate limiting between requests
-            else:
-                Tokens().mark_token_failed(token)   
+            try:
+                batch = self.apply_queue.get_nowait()
+            except queue.Empty:
+                return
+            start = time.monotonic()
+            if batch is STOP:
+                self.layer.finish()
+                return
+            kind, items = batch
+            if kind == FEATURES:
+                self.layer.add_features(items, self.do_merge)
+            elif kind == UNITS_LOADED:
+                self.units_loaded = True
+                items = [cell for cells in self.early_cells for cell in cells]
+                self.early_cells = []
+                if items:
+                    self.layer.apply_cells(items)
+            elif not self.units_loaded:
+                self.early_cells.append(items)
                 continue
-        return True
+            else:
+                self.layer.apply_cells(items)
+            self.stages["apply"].processed(len(items), time.monotonic() - start)
+
+    def cancel(self):
+        """
+        Stops the fetching when the user closes the dialog. The requests in flight give up
+        and the merged ones stay in the job, so it can be resumed.
+        """
+        self.aborted = True
+
+    def abort(self, futures):
+        """
+        Stops the fetching. Requests not yet started are cancelled and the ones in flight
+        give up instead of retrying.
+
+        Args:
+            futures (list): Futures of the fetch stage.
+        """
+        self.aborted = True
+        for future in futures:
+            future.cancel()
+
+    def fetch_stage(self, index, item, page):
+        """
+        The fetch stage of the pipeline, running in one of the pool threads.
+        Fetches a page and puts it into the decode queue, blocking while the queue is full.
+        A page that could not be fetched is passed on as None.
+        """
+        start = time.monotonic()
+        try:
+            payload = self.fetch_page(item, page)
+        except requests.exceptions.RequestException as e:
+            if not self.aborted:
+                QgsMessageLog.logMessage(f"Request for {item} page {page} failed: {e}", "QuickBDL", Qgis.Warning)
+            payload = None
+        self.stages["fetch"].processed(1, time.monotonic() - start)
+        put(self.decode_queue, (index, page, payload), self.stages["fetch"], lambda: self.aborted)
+
+    def fetch_page(self, item, page):
+        """
+        Fetch a single page of data from the API for a planned request.
+        Runs in one of the pool threads. Fresh pages are served from the response cache,
+        stale ones are revalidated with the API when it sent ETag or Last-Modified.
+
+        Args:
+            item (tuple): The planned request (endpoint, unit, variables), see RequestPlanner.plan.
+            page (int): The page number to fetch.
+
+        Returns:
+            bytes or dict: The JSON body from the API, decoded when it came from the cache,
+            None if the page could not be fetched or NO_TOKENS when no token was left.
+
+        Raises:
+            requests.exceptions.RequestException: When the request failed on the network.
+        """
+        client = BDLClient.instance()
+        pool = TokenPool.instance()
+        cache = ResponseCache.instance()
+        endpoint, unit, variables = item
+        if endpoint == BY_VARIABLE:
+            url = f"{API_DATA_URL}/by-variable/{variables[0]}"
+            params = {"unit-parent-id": unit, "unit-level": UNIT_LEVEL}
+        else:
+            url = f"{API_DATA_URL}/by-unit/{unit}"
+            params = {"var-id": list(variables)}
+        cache_key = (endpoint, variables, self.years, unit, UNIT_LEVEL, page, gus_language)
+        params.update({
+            "year": self.years,
+            "page": page,
+            "page-size": PAGE_SIZE,
+            "lang": gus_language
+        })
 
+        cached = cache.get(*cache_key)
+        if cached is not None and cached.fresh:
+            return cached.data
+
+        while not self.aborted:
+            # Get the healthiest token for the request
+            token = pool.get_token()
+            if not token:
+                return NO_TOKENS
+
+            headers = cached.validators() if cached is not None else None
+
+            # the client retries 429, 5xx and network errors with backoff,
+            # what comes back here is the final answer for this token
+            response = client.get(url, params=params, token=token, headers=headers,
+                                  stopped=lambda: self.aborted)
+            if response.status_code == 304 and cached is not None:
+                pool.report(token, response, response.elapsed.total_seconds())
+                cache.revalidated(*cache_key)
+                return cached.data
+            if response.status_code == 200:
+                pool.report(token, response, response.elapsed.total_seconds())
+                cache.put(*cache_key, response)
+                return response.content
+            if response.status_code != 429:
+                # server errors persisted through the retries, the job can be resumed later
+                return None
+            # the token is still rate limited after waiting, continue with another one
+            pool.mark_token_failed(token)
+        return None
 
     def process_response(self, data):
         """
-        Process the API response and add data to the layer.
+        Normalise the API response into cells. Handles both the by-variable responses
+        (one variable, many units) and the by-unit responses (one unit, many variables).
 
         Args:
             data (dict): The JSON response from the API.
+
+        Returns:
+            list: The cells (unit_id, variable_id, year, value).
         """
-        variable_id = str(data["variableId"])
-        
-        for result in data.get("results", []):
-            unit_id = str(result["id"])
-            
-            for value in result["values"]:
-                year = str(value["year"])
-                val = value["val"]
-                
-                self.layer.add_GUS_data(
-                    unit_id,
-                    year,
-                    val,
-                    self.variables_names[variable_id]
-                )
+        if "variableId" in data:
+            variable_id = str(data["variableId"])
+            return [
+                (str(result["id"]), variable_id, str(value["year"]), value["val"])
+                for result in data.get("results", [])
+                for value in result["values"]
+            ]
+        unit_id = str(data["unitId"])
+        return [
+            (unit_id, str(result["id"]), str(value["year"]), value["val"])
+            for result in data.get("results", [])
+            for value in result["values"]
+        ]
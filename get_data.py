@@ -10,10 +10,15 @@
 ###############################################################################
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
-from PyQt5.QtWidgets import QAction, QDialog
+from PyQt5.QtWidgets import QAction, QDialog, QMessageBox, QFileDialog
 from qgis.core import QgsProject
 import os
 from .utils.translations import _
+from .utils.jobs import FetchJob
+from .utils.database import Database
+from .utils.migrations import migrate_all
+from .utils.geometry import AUTO_DETAIL, Geometry
+from .create_layer import MEMORY_OUTPUT, DATABASE_OUTPUT, FILE_OUTPUT
 from .config import DB_PATH,DATABASE_URL
 from .subjects_form import SubjectsForm
 from .units_form import UnitsForm
@@ -48,8 +53,15 @@ class GetBDLData(QAction):
         self.variables = [] 
         self.units = []
         self.variableNames = {}
+        self.years = []
+        self.detail = AUTO_DETAIL
+        self.output = MEMORY_OUTPUT
+        self.path = None
         self.layer = None
 
+        # An outdated database is offered for download once per session
+        self.update_offered = False
+
     def run(self):
         """
         Initiates the plugin by resetting data and launching the first form.
@@ -57,6 +69,10 @@ class GetBDLData(QAction):
         # Clear previous session data
         self.variables.clear()
         self.units.clear()
+        self.years = []
+        self.detail = AUTO_DETAIL
+        self.output = MEMORY_OUTPUT
+        self.path = None
 
         self.layer = None
 
@@ -67,12 +83,76 @@ class GetBDLData(QAction):
             # if not exists we need to download it
             dialog = DataInitializationDialog(DB_PATH, DATABASE_URL)
             if dialog.exec_() != QDialog.Accepted:
-                os.remove(DB_PATH)
+                Database.instance().delete(DB_PATH)
                 return
 
+        # Tables and indexes are created or upgraded once here, not by every class using them
+        migrate_all()
+
+        # Tables derived from the geometries come with the database, an older file still works
+        # with rural areas computed on the fly and geometries in full detail
+        if not self.update_offered and not Geometry().is_current():
+            self.update_offered = True
+            answer = QMessageBox.question(
+                self.iface.mainWindow(),
+                _("Update database"),
+                _("The database file is outdated, layers are slower to create with it. Do you want to download it again now?"),
+                QMessageBox.Yes | QMessageBox.No
+            )
+            if answer == QMessageBox.Yes:
+                dialog = DataInitializationDialog(DB_PATH, DATABASE_URL)
+                if dialog.exec_() != QDialog.Accepted:
+                    Database.instance().delete(DB_PATH)
+                    return
+                migrate_all()
+                if not Geometry().is_current():
+                    QMessageBox.warning(
+                        self.iface.mainWindow(),
+                        _("Update database"),
+                        _("The downloaded database file is outdated too.")
+                    )
+                    return
+
+        # An interrupted fetch can be continued instead of starting over
+        if self.resume_unfinished_job():
+            return
+
         # Launch the first form
         self.show_approach_form()
 
+    def resume_unfinished_job(self):
+        """
+        Offers to resume the last unfinished data fetching job. If the user agrees, the job is
+        fetched with its original selection, otherwise it is discarded.
+
+        Returns:
+            bool: True if the job was resumed.
+        """
+        job = FetchJob.unfinished()
+        if job is None:
+            return False
+
+        answer = QMessageBox.question(
+            self.iface.mainWindow(),
+            _("Resume data fetching"),
+            _("The previous data fetching was not finished. Do you want to resume it?"),
+            QMessageBox.Yes | QMessageBox.No
+        )
+        if answer != QMessageBox.Yes:
+            FetchJob.discard(job["job_id"])
+            return False
+
+        self.do_merge = job["do_merge"]
+        self.units = job["units"]
+        self.variables = job["variables"]
+        self.variableNames = job["variables_names"]
+        self.years = job["years"]
+        self.detail = job["detail"]
+        self.output = job["output"]
+        self.path = job["output_path"]
+        self.show_datafetch_form(job["job_id"])
+        return True
+
     def show_approach_form(self):
         """
         Displays the approach selection form and connects its completion
@@ -84,6 +164,17 @@ class GetBDLData(QAction):
             # If the dialog is closed, terminate the plugin
             return
         self.do_merge = self.approach_form.option2.isChecked()
+        self.detail = self.approach_form.detail_combo.currentData()
+        self.output = self.approach_form.output_combo.currentData()
+        if self.output == FILE_OUTPUT:
+            # the layer is written to the file while the data is fetched
+            self.path, _selected_filter = QFileDialog.getSaveFileName(
+                self.iface.mainWindow(), _("Save layer as"), "", _("GeoPackage file") + " (*.gpkg)"
+            )
+            if not self.path:
+                return
+            if not self.path.lower().endswith(".gpkg"):
+                self.path += ".gpkg"
         self.show_units_form()
 
     def show_units_form(self):
@@ -103,7 +194,7 @@ class GetBDLData(QAction):
     def show_subjects_form(self):
         """
         Displays the subjects selection form and connects its completion
-        to the data fetching form.
+        to the years form.
         """
         self.subjects_form = SubjectsForm(self.variableNames)
         result = self.subjects_form.exec_()
@@ -112,47 +203,58 @@ class GetBDLData(QAction):
             return
         self.variables = self.subjects_form.selected_codes
         self.variableNames = self.subjects_form.variableNames
+        self.show_years_form()
+
+    def show_years_form(self):
+        """
+        Displays the years selection form before data fetching, so only the selected
+        years are requested from the API. The available years come from the metadata
+        of the selected variables, they are loaded by the form in the background.
+        """
+        self.years_form = YearsForm(self.variables)
+        result = self.years_form.exec_()
+        if result == QDialog.Rejected:
+            # If the dialog is closed, terminate the plugin
+            return
+        self.years = list(self.years_form.selected_years)
         self.show_datafetch_form()
 
-    def show_datafetch_form(self):
+    def show_datafetch_form(self, job_id=None):
         """
         Displays the data fetching form, initiates API requests, 
         and tracks progress for data retrieval.
+
+        Args:
+            job_id (int): ID of an unfinished fetch job to resume, None starts a new one.
         """        
         self.datafetch_form = DataFetchForm(
             self.do_merge,
             self.units,
             self.variables,
             self.variableNames,
+            self.years,
+            job_id,
+            self.detail,
+            self.output,
+            self.path,
         )
         result = self.datafetch_form.exec_()
-        if result == QDialog.Rejected:
-            # If the dialog is closed, terminate the plugin
-            return
-        self.show_years_form()
-        
-    def show_years_form(self):
-        """
-        Displays the years selection form after data fetching and 
-        connects its completion to data processing.
-        """
-
-        # Get the fetched data layer from the data fetching form
-        self.layer = self.datafetch_form.worker.layer
-
-        self.years_form = YearsForm(self.layer.year_columns.keys())
-        result = self.years_form.exec_()
         if result == QDialog.Rejected:
             # If the dialog is closed, terminate the plugin
             return
         self.process_data()
-        
 
     def process_data(self):
         """
-        Finalizes data retrieval and processing by removing 
-        unnecessary columns and adding the processed data to QGIS as a layer.
+        Finalizes data retrieval by adding the fetched data to QGIS as a layer.
+        The layer holds columns for the selected years only.
         """        
-        self.layer.remove_unwanted_years_columns(self.years_form.selected_years)
+        # Get the fetched data layer from the data fetching form
+        self.layer = self.datafetch_form.worker.layer
+        if self.layer.output == DATABASE_OUTPUT:
+            # the attributes stay in the project without a legend entry, joined to the geometries
+            QgsProject.instance().addMapLayer(self.layer, False)
+            QgsProject.instance().addMapLayer(self.layer.spatial_layer(self.datafetch_form.worker.table))
+            return
         QgsProject.instance().addMapLayer(self.layer)
         
\ No newline at end of file
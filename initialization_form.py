@@ -16,6 +16,9 @@ import requests
 from PyQt5.QtWidgets import QDialog, QVBoxLayout, QPushButton, QLabel, QProgressBar
 from PyQt5.QtCore import Qt, QThread, pyqtSignal
 from .utils.translations import _
+from .utils.hierarchy import TerytIndex
+from .utils.geometry import GeometryCache
+from .utils.database import Database
 
 class DataInitializationWorker(QThread):
     progress_updated = pyqtSignal(int)  # Signal to update progress bar
@@ -30,6 +33,8 @@ class DataInitializationWorker(QThread):
     def run(self):
         """Download the file and update progress."""
         try:
+            # WAL files left by a previous database file would corrupt the new one
+            Database.instance().delete(self.target_file)
             response = requests.get(self.download_url, stream=True, timeout=10)
             response.raise_for_status()  # Raise an error for HTTP issues
 
@@ -46,7 +51,8 @@ class DataInitializationWorker(QThread):
                         self.progress_updated.emit(progress)
 
             self.download_completed.emit()
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, OSError) as e:
+            # the file may be locked by another program or not writable
             self.download_failed.emit(str(e))
 
 class DataInitializationDialog(QDialog):
@@ -102,6 +108,8 @@ class DataInitializationDialog(QDialog):
         """Handle successful download."""
 
         self.status_label.setText(_("Database file downloaded successfully."))
+        TerytIndex.reset()  # the index was loaded from the replaced file
+        GeometryCache.instance().clear()
         self.accept()  # Close the dialog
 
     def on_download_failed(self, error_message):
@@ -15,6 +15,7 @@ from PyQt5.QtWidgets import QMessageBox
 from PyQt5.QtGui import QIcon
 from PyQt5 import uic
 from .get_data import GetBDLData
+from .utils.database import Database
 
 class QuickBDL(object):
     def __init__(self,iface):
@@ -42,6 +43,7 @@ class QuickBDL(object):
         for action in self.menu_actions:
             self.iface.removePluginMenu(self.plugin_menu_entry,action)
             self.iface.removeToolBarIcon(action)
+        Database.instance().close_all()
 
     def ui_loader(self,*ui_name):
         """
@@ -12,11 +12,10 @@ __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
 
 
-import sqlite3
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtWidgets import QDialog, QTreeView, QVBoxLayout, QPushButton, QHeaderView, QLabel
 from PyQt5.QtCore import Qt
-from .config import DB_PATH
+from .utils.database import reader
 from .utils.translations import _, gus_language
 from .columnname_form import ChooseColumnName
 
@@ -83,7 +82,7 @@ class SubjectsForm(QDialog):
 
     def load_root_data(self):
         """Loads the root-level subjects from the database into the tree view."""
-        with sqlite3.connect(DB_PATH) as conn:
+        with reader() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT subject_code, name FROM subjects WHERE parent_id IS NULL and language = ?", (gus_language,))
             subjects = cursor.fetchall()
@@ -128,7 +127,7 @@ class SubjectsForm(QDialog):
             parent_item (QStandardItem): The parent item to which children will be added.
             parent_id (str): The ID of the parent item.
         """
-        with sqlite3.connect(DB_PATH) as conn:
+        with reader() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT subject_code, name FROM subjects WHERE parent_id = ? and language = ?", (parent_id,gus_language))
             children = cursor.fetchall()
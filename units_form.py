@@ -10,14 +10,13 @@
 ###############################################################################
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
-import sqlite3
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtWidgets import QTreeView, QVBoxLayout, QPushButton, QHeaderView, QDialog
 from PyQt5.QtCore import Qt
-from .config import DB_PATH
 from .utils.translations import _, gus_language
 from .utils.teryt import Teryt
 from .utils.expander import Expander
+from .utils.hierarchy import TerytIndex
 
 class UnitsForm(QDialog):
     """
@@ -37,6 +36,8 @@ class UnitsForm(QDialog):
         self.do_merge = do_merge  # Merge flag for handling smallest units
         self.full_code_list = []  # List to store selected codes
         self.teryt = Teryt()
+        self.expander = Expander()
+        self.index = TerytIndex.instance()
 
         # Tree view to display territorial units
         self.tree_view = QTreeView()
@@ -82,56 +83,49 @@ class UnitsForm(QDialog):
         """
         Loads voivodeships (level 2) and their subregions (level 4) into the tree view.
         """
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Fetch voivodeships (level 2) 
-            cursor.execute("SELECT full_code, short_code, name, kind, level FROM teryt_codes WHERE level = 2 and language = ?", (gus_language,))
-            regions = cursor.fetchall()
-
-            # Fetch subregions (level 4)
-            cursor.execute("SELECT full_code, short_code, name, kind, level FROM teryt_codes WHERE level = 4 and language = ?", (gus_language,))
-            subregions = cursor.fetchall()
+        # Voivodeships (level 2) and subregions (level 4) from the TERYT index
+        regions = self.index.units(2, gus_language)
+        subregions = self.index.units(4, gus_language)
 
-            for full_code, short_code, name, kind, level in regions:
-                # Create voivodeship items
-                region_item = QStandardItem(name)
-                region_item.setData(full_code)
-                region_item.setFlags(region_item.flags() & ~Qt.ItemIsEditable)
+        for full_code, short_code, name, kind, level in regions:
+            # Create voivodeship items
+            region_item = QStandardItem(name)
+            region_item.setData(full_code)
+            region_item.setFlags(region_item.flags() & ~Qt.ItemIsEditable)
 
-                type_item = QStandardItem(_("Voivodeship"))
-                type_item.setFlags(type_item.flags() & ~Qt.ItemIsEditable)
+            type_item = QStandardItem(_("Voivodeship"))
+            type_item.setFlags(type_item.flags() & ~Qt.ItemIsEditable)
 
-                short_code_item = QStandardItem(short_code)
-                short_code_item.setFlags(short_code_item.flags() & ~Qt.ItemIsEditable)
+            short_code_item = QStandardItem(short_code)
+            short_code_item.setFlags(short_code_item.flags() & ~Qt.ItemIsEditable)
 
-                full_code_item = QStandardItem(full_code)
-                full_code_item.setFlags(full_code_item.flags() & ~Qt.ItemIsEditable)
+            full_code_item = QStandardItem(full_code)
+            full_code_item.setFlags(full_code_item.flags() & ~Qt.ItemIsEditable)
 
-                # Add subregions for the voivodeship
-                for sub_full_code, sub_short_code, sub_name, sub_kind, sub_level in subregions:
-                    if sub_full_code.startswith(full_code[:4]):
-                        subregion_item = QStandardItem(sub_name)
-                        subregion_item.setData(sub_full_code)
-                        subregion_item.setFlags(subregion_item.flags() & ~Qt.ItemIsEditable)
-                        subregion_item.setCheckable(True)  # Checkbox for subregions
+            # Add subregions for the voivodeship
+            for sub_full_code, sub_short_code, sub_name, sub_kind, sub_level in subregions:
+                if sub_full_code.startswith(full_code[:4]):
+                    subregion_item = QStandardItem(sub_name)
+                    subregion_item.setData(sub_full_code)
+                    subregion_item.setFlags(subregion_item.flags() & ~Qt.ItemIsEditable)
+                    subregion_item.setCheckable(True)  # Checkbox for subregions
 
-                        sub_type_item = QStandardItem(_("Subregion"))
-                        sub_type_item.setFlags(sub_type_item.flags() & ~Qt.ItemIsEditable)
+                    sub_type_item = QStandardItem(_("Subregion"))
+                    sub_type_item.setFlags(sub_type_item.flags() & ~Qt.ItemIsEditable)
 
-                        sub_short_code_item = QStandardItem(sub_short_code)
-                        sub_short_code_item.setFlags(sub_short_code_item.flags() & ~Qt.ItemIsEditable)
+                    sub_short_code_item = QStandardItem(sub_short_code)
+                    sub_short_code_item.setFlags(sub_short_code_item.flags() & ~Qt.ItemIsEditable)
 
-                        sub_full_code_item = QStandardItem(sub_full_code)
-                        sub_full_code_item.setFlags(sub_full_code_item.flags() & ~Qt.ItemIsEditable)
+                    sub_full_code_item = QStandardItem(sub_full_code)
+                    sub_full_code_item.setFlags(sub_full_code_item.flags() & ~Qt.ItemIsEditable)
 
-                        # Add dummy item for further expansion
-                        subregion_item.appendRow([QStandardItem(_("Loading...")), QStandardItem(""), QStandardItem(""), QStandardItem("")])
+                    # Add dummy item for further expansion
+                    subregion_item.appendRow([QStandardItem(_("Loading...")), QStandardItem(""), QStandardItem(""), QStandardItem("")])
 
-                        region_item.appendRow([subregion_item, sub_type_item, sub_short_code_item, sub_full_code_item])
+                    region_item.appendRow([subregion_item, sub_type_item, sub_short_code_item, sub_full_code_item])
 
-                # Add voivodeship to the model
-                self.model.appendRow([region_item, type_item, short_code_item, full_code_item])
+            # Add voivodeship to the model
+            self.model.appendRow([region_item, type_item, short_code_item, full_code_item])
 
     def on_item_expanded(self, index):
         """
@@ -158,12 +152,12 @@ class UnitsForm(QDialog):
             full_code (str): The full code of the parent item.
         """
 
-        childrens = Expander().expand_code(full_code)
+        childrens = self.expander.expand_code(full_code)
         if childrens is None:
             return
         for full_code, name, kind, level in childrens:
             
-            type_name = Teryt().get_type_name(level, kind)
+            type_name = self.teryt.get_type_name(level, kind)
             short_code = full_code[2:4] + full_code[7:11]
 
             child_item = QStandardItem(name)
@@ -181,7 +175,7 @@ class UnitsForm(QDialog):
             full_code_item.setFlags(full_code_item.flags() & ~Qt.ItemIsEditable)
 
             
-            if Expander().expandable(full_code, self.do_merge):
+            if self.expander.expandable(full_code, self.do_merge):
                 child_item.appendRow([QStandardItem(_("Loading...")), QStandardItem(""), QStandardItem(""), QStandardItem("")])
 
             item.appendRow([child_item, type_item, short_code_item, full_code_item])
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+class CellFilter(object):
+    """
+    Keeps the fetched values that belong to the layer. The by-variable requests of a common
+    parent return every unit below it and the API may return years or variables that were
+    not asked for, only the cells of the layer units, the selected variables and years pass.
+    """
+    def __init__(self, unit_ids, variable_ids, years):
+        """
+        Args:
+            unit_ids (list): Unit codes of the layer.
+            variable_ids (list): The selected variable IDs.
+            years (list): The selected years.
+        """
+        self.unit_ids = {str(unit_id) for unit_id in unit_ids}
+        self.variable_ids = {str(variable_id) for variable_id in variable_ids}
+        self.years = {str(year) for year in years}
+
+    def filter(self, cells):
+        """
+        Returns the cells of the layer.
+
+        Args:
+            cells (iterable): Tuples (unit_id, variable_id, year, value).
+
+        Returns:
+            list: The cells with a value for a unit, variable and year of the layer.
+        """
+        return [
+            cell for cell in cells
+            if cell[3] is not None
+            and cell[0] in self.unit_ids
+            and cell[1] in self.variable_ids
+            and cell[2] in self.years
+        ]
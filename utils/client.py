@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from ..config import MAX_CONCURRENT_REQUESTS
+from .rate_limiter import RateLimiter, sleep
+from .retry import RetryPolicy
+
+CONNECT_TIMEOUT = 10  # seconds to establish a connection
+READ_TIMEOUT = 60  # seconds to wait for the server between bytes of a response
+
+
+class RequestAborted(requests.exceptions.RequestException):
+    """
+    Raised when the caller stops while a request waits for the rate limiter or a retry.
+    """
+
+
+class BDLClient(object):
+    """
+    HTTP client shared by every call to the BDL API and the geoportal WFS service.
+    Keeps a pool of keep-alive connections, sets timeouts on every request and asks
+    the rate limiter before each request made with a client id.
+
+    Retries are decided by a retry policy: an object with a method
+    `retry_delay(attempt, response, error)` returning the number of seconds to wait
+    before the next attempt or None to give up. Without a policy every request is sent once.
+    The shared client uses RetryPolicy. Every response carries the number of retries
+    it took in its `retries` attribute.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the client shared by the whole QGIS session.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(retry_policy=RetryPolicy())
+            return cls._instance
+
+    def __init__(self, retry_policy=None, pool_size=MAX_CONCURRENT_REQUESTS):
+        self.retry_policy = retry_policy
+        self.limiter = RateLimiter.instance()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+        })
+
+    def get(self, url, params=None, token=None, headers=None, timeout=None, stream=False, retry_policy=None,
+            stopped=None):
+        """
+        Sends a GET request through the shared session.
+
+        Args:
+            url (str): The requested URL.
+            params (dict): Query parameters.
+            token (str): BDL client id, sent as X-ClientId and accounted in the rate limiter.
+            headers (dict): Additional request headers.
+            timeout (tuple): (connect, read) timeout in seconds, defaults to the module settings.
+            stream (bool): Whether the response body should be streamed.
+            retry_policy (object): Overrides the retry policy of the client for this request.
+            stopped (callable): Returns True when the caller stops, ends the waits before
+                the next attempt. May be None.
+
+        Returns:
+            requests.Response: The last response received, with the number of retries
+                in its `retries` attribute.
+
+        Raises:
+            requests.exceptions.RequestException: When the request fails on the network
+                and the retry policy gives up.
+            RequestAborted: When the caller stops while waiting.
+        """
+        policy = retry_policy if retry_policy is not None else self.retry_policy
+        request_headers = dict(headers or {})
+        if token is not None:
+            request_headers["X-ClientId"] = token
+
+        attempt = 0
+        while True:
+            if token is not None and not self.limiter.acquire(token, stopped):
+                raise RequestAborted("The request was stopped")
+
+            response, error = None, None
+            try:
+                response = self.session.get(
+                    url,
+                    params=params,
+                    headers=request_headers,
+                    timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT),
+                    stream=stream
+                )
+            except requests.exceptions.RequestException as e:
+                error = e
+
+            if token is not None and response is not None:
+                self.limiter.update(token, response)
+
+            delay = policy.retry_delay(attempt, response, error) if policy is not None else None
+            if delay is None:
+                if error is not None:
+                    error.retries = attempt
+                    raise error
+                response.retries = attempt
+                return response
+            attempt += 1
+            if not sleep(delay, stopped):
+                raise RequestAborted("The request was stopped")
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from ..config import DB_PATH
+
+MMAP_SIZE = 256 * 1024 * 1024  # bytes of the database file mapped into memory by readers
+CACHE_SIZE = 64 * 1024  # KiB of page cache per connection
+BUSY_TIMEOUT = 10000  # milliseconds a connection waits for a lock held by another one
+
+
+class Database(object):
+    """
+    Central manager of the SQLite connections of the plugin, for data.sqlite and the cache file.
+
+    Reads go through long-lived read-only connections, one per thread and file, opened with
+    mode=ro and query_only and tuned with mmap_size and a larger page cache.
+    All writes to a file go through its single writer connection in WAL mode, so readers
+    are not blocked by writes. The writer is shared by all threads and guarded by a lock.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the manager shared by the whole QGIS session.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.local = threading.local()  # readers of each thread: {path: (generation, connection)}
+        self.generations = {}  # {path: generation}, bumped by close() to drop the readers
+        self.readers = {}  # {path: [connection]}, readers of all threads, closed by close()
+        self.writers = {}  # {path: connection}
+        self.writer_locks = {}  # {path: lock}
+        self.lock = threading.Lock()
+
+    def reader(self, path=DB_PATH):
+        """
+        Returns the read-only connection of the current thread to the database file.
+        The connection stays open, it must not be closed by the caller.
+
+        Args:
+            path (str): Path of the database file.
+
+        Returns:
+            sqlite3.Connection: The read-only connection.
+        """
+        readers = getattr(self.local, "readers", None)
+        if readers is None:
+            readers = self.local.readers = {}
+        with self.lock:
+            generation = self.generations.get(path, 0)
+
+        if path in readers:
+            reader_generation, conn = readers[path]
+            if reader_generation == generation:
+                return conn
+            # already closed by close(), only forget it here
+            del readers[path]
+
+        conn = sqlite3.connect(f"{Path(path).as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE}")
+        conn.execute("PRAGMA query_only = 1")
+        with self.lock:
+            if self.generations.get(path, 0) != generation:
+                # the file was closed while connecting, the connection must not outlive it
+                conn.close()
+                return self.reader(path)
+            self.readers.setdefault(path, []).append(conn)
+        readers[path] = (generation, conn)
+        return conn
+
+    @contextmanager
+    def writer(self, path=DB_PATH):
+        """
+        Gives the writer connection of the database file for one transaction. The transaction
+        is committed when the block ends and rolled back when it raises. Other threads wait
+        for their turn.
+
+        Args:
+            path (str): Path of the database file.
+
+        Yields:
+            sqlite3.Connection: The writer connection.
+        """
+        with self.lock:
+            if path not in self.writers:
+                conn = sqlite3.connect(path, check_same_thread=False)
+                conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute("PRAGMA synchronous = NORMAL")
+                conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE}")
+                self.writers[path] = conn
+                self.writer_locks[path] = threading.RLock()
+            conn = self.writers[path]
+            writer_lock = self.writer_locks[path]
+
+        with writer_lock:
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def close(self, path=DB_PATH):
+        """
+        Closes the writer and the readers of every thread to the database file, so the file
+        can be replaced. The readers are reopened the next time they are asked for.
+        """
+        with self.lock:
+            self.generations[path] = self.generations.get(path, 0) + 1
+            conn = self.writers.pop(path, None)
+            self.writer_locks.pop(path, None)
+            readers = self.readers.pop(path, [])
+        if conn is not None:
+            conn.close()
+        for reader_conn in readers:
+            reader_conn.close()
+
+    def delete(self, path=DB_PATH):
+        """
+        Closes the connections to the database file and removes it together with
+        its WAL files, which must not outlive the file they belong to.
+        """
+        self.close(path)
+        for file_path in (path, path + "-wal", path + "-shm"):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def close_all(self):
+        """
+        Closes the connections to every database file.
+        """
+        with self.lock:
+            paths = set(self.writers) | set(self.generations)
+        for path in paths:
+            self.close(path)
+
+
+def reader(path=DB_PATH):
+    """
+    Shortcut for Database.instance().reader(path).
+    """
+    return Database.instance().reader(path)
+
+
+def writer(path=DB_PATH):
+    """
+    Shortcut for Database.instance().writer(path).
+    """
+    return Database.instance().writer(path)
@@ -10,13 +10,48 @@
 ###############################################################################
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
-import sqlite3
+import json
 
-from .teryt import Teryt
-from .geometry import Geometry
-from ..config import DB_PATH
+from .hierarchy import TerytIndex
+from .geometry import Geometry, FULL_DETAIL
+from .database import reader
 from .translations import _, gus_language
 
+RESOLVE_CHUNK_SIZE = 500  # units whose names and geometries are loaded at once
+
+# Whether the unit in the row `e` is expanded further, the SQL form of Expander.expandable.
+# `e.zeros` holds the number of trailing zeros of the code.
+_EXPANDABLE = """(
+    e.zeros >= 3 OR
+    (e.zeros = 0 AND NOT :merge AND (substr(e.full_code, 12, 1) = '3' OR e.full_code = '071412865011'))
+)"""
+
+# Expands the codes of the JSON array :codes down to the units that are not expandable,
+# following the same rules as Expander.expand_code: counties are expanded to their communes
+# that have a geometry, the other units to their children by parent code.
+EXPAND_QUERY = f"""
+    WITH RECURSIVE expanded(position, full_code, zeros) AS (
+        SELECT key, value, length(value) - length(rtrim(value, '0'))
+        FROM json_each(:codes)
+        UNION
+        SELECT e.position, t.full_code, length(t.full_code) - length(rtrim(t.full_code, '0'))
+        FROM expanded AS e
+        JOIN teryt_codes AS t ON t.language = :language AND (
+            (e.zeros != 3 AND {_EXPANDABLE} AND t.parent_code = e.full_code)
+            OR
+            (e.zeros = 3 AND t.kind IN ('1', '2', '3')
+                AND t.short_code BETWEEN substr(e.full_code, 3, 2) || substr(e.full_code, 8, 2) || '00'
+                                     AND substr(e.full_code, 3, 2) || substr(e.full_code, 8, 2) || '99'
+                AND EXISTS (SELECT 1 FROM geometries AS g WHERE g.code = t.short_code AND g.type = t.kind))
+        )
+    )
+    SELECT e.full_code
+    FROM expanded AS e
+    WHERE NOT {_EXPANDABLE}
+    GROUP BY e.full_code
+    ORDER BY MIN(e.position), e.full_code
+"""
+
 
 class Expander(object):
     def __init__(self):
@@ -56,53 +91,14 @@ class Expander(object):
             return None
 
     def _expand_with_parent_code(self, full_code):
-        
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    full_code,
-                    name,
-                    kind,
-                    level
-                FROM teryt_codes
-                WHERE parent_code = ? AND language = ?""", (full_code, gus_language))
-            return cursor.fetchall()
+        return TerytIndex.instance().children(full_code, gus_language)
 
     def _expand_county(self, full_code):
-        voivodship = full_code[2:4]
-        county = full_code[7:9]
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    code,
-                    type
-                FROM geometries
-                WHERE code LIKE ?""", (voivodship + county + '%',))
-            result = cursor.fetchall()
-            
-            if not result:
-                return None
-            
-            final_result = []
-            for row in result:
-                
-                if row[1] not in ['1','2','3']:
-                    continue
-                cursor.execute("""
-                    SELECT 
-                        full_code,
-                        name,
-                        kind,
-                        level
-                    FROM teryt_codes
-                    WHERE short_code = ? AND kind = ? AND language = ?""", (row[0], row[1], gus_language))
-                all_rows = cursor.fetchall()
-                assert len(all_rows) == 1
-                final_result.extend(all_rows)
-            return final_result
-        
+        # communes of the county that have a geometry, cities in urban-rural
+        # communes and rural areas are reached through their urban-rural commune
+        result = TerytIndex.instance().communes_of_county(full_code, gus_language)
+        return result if result else None
+
     def expandable(self, full_code, do_merge):
         """
         Determines if a unit code is expandable.
@@ -124,36 +120,76 @@ class Expander(object):
             return False
     
 
-    def codes_name_geometry(self, full_codes, do_merge):
+    def expand_codes(self, full_codes, do_merge):
         """
-        Expands a list of unit codes to their children and retrieves their names and geometries.
+        Expands a list of unit codes to the units that are not expandable any more.
+        The whole selection is passed as a JSON array and expanded with one recursive query,
+        see EXPAND_QUERY.
 
         Args:
             full_codes (list): A list of full unit codes.
             do_merge (bool): Whether to merge the rural comunes inside.
 
         Returns:
-            list: A list of tuples containing the full code, name, and geometry of each unit.
+            list: Full codes of the expanded units, in the order of the selected codes they come from.
+        """
+        with reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(EXPAND_QUERY, {
+                "codes": json.dumps(list(full_codes)),
+                "language": gus_language,
+                "merge": int(bool(do_merge))
+            })
+            return [row[0] for row in cursor.fetchall()]
+
+    def names_geometries(self, full_codes, chunk_size=RESOLVE_CHUNK_SIZE, level=FULL_DETAIL):
         """
-        # code expands list as long as any item is expandable
-        # later zips with geometry and name
-        while any(self.expandable(code, do_merge) for code in full_codes):
-            new_codes = []
-            for code in full_codes:
-                if self.expandable(code, do_merge):
-                    for row in self.expand_code(code):
-                        new_codes.append(row[0])
-                else:
-                    new_codes.append(code)
-            full_codes = new_codes
-        names = []
-        geometries = []
+        Retrieves names and geometries of units. Names come from the TERYT index, geometries
+        are loaded for chunks of codes with one set-based query and yielded one unit at a time.
 
+        Args:
+            full_codes (list): Full codes of units that are not expandable.
+            chunk_size (int): Units resolved with one set of queries.
+            level (int): The level of detail of the geometries.
+
+        Yields:
+            tuple: The full code, name, and geometry of each unit.
+        """
+        index = TerytIndex.instance()
+        geometry = Geometry()
+        with reader() as conn:
+            for start in range(0, len(full_codes), chunk_size):
+                chunk = full_codes[start:start + chunk_size]
+                codes = [(full_code[2:4]+full_code[7:11], full_code[-1]) for full_code in chunk]
+
+                geometries = geometry.geometries_from_codes(conn, codes, level)
+                for full_code, code in zip(chunk, codes):
+                    yield full_code, index.name(code[0], code[1], gus_language), geometries.get(code)
+
+    def names(self, full_codes):
+        """
+        Retrieves names of units from the TERYT index, for layers that take their geometries
+        from the database through OGR.
+
+        Args:
+            full_codes (list): Full codes of units that are not expandable.
+
+        Yields:
+            tuple: The full code, name, and None in place of the geometry of each unit.
+        """
+        index = TerytIndex.instance()
         for full_code in full_codes:
-            shorter_code = full_code[2:4]+full_code[7:11]
-            kind = full_code[-1]
+            yield full_code, index.name(full_code[2:4]+full_code[7:11], full_code[-1], gus_language), None
+
+    def codes_name_geometry(self, full_codes, do_merge):
+        """
+        Expands a list of unit codes to their children and retrieves their names and geometries.
 
-            names.append(Teryt().code_to_name(shorter_code,kind, gus_language))
-            geometries.append(Geometry().geometry_from_code(shorter_code, kind))
+        Args:
+            full_codes (list): A list of full unit codes.
+            do_merge (bool): Whether to merge the rural comunes inside.
 
-        return zip(full_codes, names, geometries)
+        Returns:
+            list: A list of tuples containing the full code, name, and geometry of each unit.
+        """
+        return list(self.names_geometries(self.expand_codes(full_codes, do_merge)))
@@ -10,89 +10,314 @@
 ###############################################################################
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
-import requests
-import sqlite3
+import json
+import threading
+from collections import OrderedDict
 import geopandas as gpd
 import pandas as pd
 from io import BytesIO
 from ..config import DB_PATH
-import binascii
+from .database import reader, writer
+from .migrations import index_geometries, create_topology
+from .topology import Topology
+from .geopackage import GeoPackage, GPKG_HEADER_SIZE, table_name
+from .client import BDLClient, CONNECT_TIMEOUT
 
 wfs_url = 'https://mapy.geoportal.gov.pl/wss/service/PZGIK/PRG/WFS/AdministrativeBoundaries'
+WFS_READ_TIMEOUT = 600  # the whole country boundaries are sent in one response
+GEOMETRY_CACHE_SIZE = 256 * 1024 * 1024  # bytes of WKB of the decoded geometries kept for the session
+
+# Levels of detail of the geometries. Level 0 is the full PRG resolution in the geometries table,
+# the other levels are simplified with the tolerance in metres (EPSG:2180) and kept in the GeoPackage tables.
+FULL_DETAIL = 0
+AUTO_DETAIL = None  # the level is picked by auto_detail
+LOD_TOLERANCES = {1: 20.0, 2: 100.0, 3: 500.0}
+
+# (units, level): layers with more units than given get at least the level, see auto_detail
+LOD_UNITS = [(30, 1), (300, 2), (1000, 3)]
+
+
+def auto_detail(unit_count):
+    """
+    Picks the level of detail for a layer. The units of a layer are communes, cities and
+    rural areas of similar size, so their number tells the extent of the layer: a county
+    keeps the full resolution, a voivodeship or the whole country are simplified.
+
+    Args:
+        unit_count (int): Number of units of the layer.
+
+    Returns:
+        int: The level of detail.
+    """
+    level = FULL_DETAIL
+    for units, units_level in LOD_UNITS:
+        if unit_count > units:
+            level = units_level
+    return level
+
+
+def _source(level):
+    # table expression with the columns code, type and geometry of a level of detail
+    if level == FULL_DETAIL:
+        return "geometries"
+    # the WKB of a simplified geometry follows the header of its GeoPackage geometry
+    return f"(SELECT short_code AS code, type, substr(geom, {GPKG_HEADER_SIZE + 1}) AS geometry FROM {table_name(level)})"
+
+
+class GeometryCache(object):
+    """
+    Decoded geometries of the QGIS session keyed by (shorter_code, kind, level), so repeated
+    extracts of overlapping areas do not decode them again. The least recently used
+    geometries are dropped when their WKB size exceeds the limit. Safe to use from many threads.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the cache shared by the whole QGIS session.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, max_size=GEOMETRY_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()  # {(shorter_code, kind, level): (geometry, size)}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns a copy of the cached geometry or None. Copies of QgsGeometry share the data
+        until one of them is modified, so the cached geometry is never changed by callers.
+        """
+        from qgis.core import QgsGeometry
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        return QgsGeometry(entry[0])
+
+    def put(self, key, geometry, size):
+        """
+        Stores a decoded geometry and drops the least recently used ones over the limit.
+
+        Args:
+            key (tuple): (shorter_code, kind, level).
+            geometry (QgsGeometry): The decoded geometry.
+            size (int): Size of its WKB in bytes.
+        """
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (geometry, size)
+            self.size += size
+            while self.size > self.max_size and len(self.entries) > 1:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        """
+        Drops all geometries, used after the database file was replaced.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
 class Geometry(object):
-    def __init__(self):
-        with sqlite3.connect(DB_PATH) as conn:
-            
-            # if geometries table does not exist just leave
-            if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='geometries';").fetchone() is not None:
-                return
-            
-            # Create the table 'geometries' if it does not exist
-            conn.execute("CREATE INDEX idx_code ON geometries (code);")
-
-            # Create a unique index on the pair 'code' and 'type'
-            conn.execute("CREATE UNIQUE INDEX idx_code_type ON geometries (code, type);")
-
-    def _hex_to_geometry(self, hex_geom):
+    def _wkb_to_geometry(self, wkb):
         # import QgsGeometry from qgis.core only if needed
         from qgis.core import QgsGeometry
-        wkb_hex = hex_geom
-        wkb_bytes = binascii.unhexlify(wkb_hex)
         geometry = QgsGeometry()
-        geometry.fromWkb(wkb_bytes)
+        geometry.fromWkb(wkb)
         return geometry
-    
-    def _get_geometry(self, shorter_code, kind):
+
+    def _decode(self, key, wkb):
+        # the blob is passed to fromWkb as read, the decoded geometry is kept for the session
+        from qgis.core import QgsGeometry
+        geometry = self._wkb_to_geometry(wkb)
+        GeometryCache.instance().put(key, geometry, len(wkb))
+        # the entry may already be evicted by another thread, the caller gets its own copy
+        return QgsGeometry(geometry)
+
+    def _get_geometry(self, shorter_code, kind, level=FULL_DETAIL):
         """
-        Retrieves the geometry for a given code and kind from the database.
+        Retrieves the geometry for a given code and kind from the session cache or the database.
 
         Args:
             shorter_code (str): The shorter code to get the geometry for.
             kind (str): The type of geometry to retrieve.
+            level (int): The level of detail.
 
         Returns:
             QgsGeometry: The resulting geometry or None if not found.
         """
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT hex(geometry)
-                FROM geometries
-                WHERE code = ? AND type = ?
-            ''', (shorter_code, kind))
-            row = cursor.fetchone()
-            if not row:
-                return None
-            hex_geometry = row[0]
-            return self._hex_to_geometry(hex_geometry)
+        with reader() as conn:
+            return self.geometries_from_codes(conn, [(shorter_code, kind)], level).get((shorter_code, kind))
 
-    def geometry_from_code(self, shorter_code, kind):
+    def geometry_from_code(self, shorter_code, kind, level=FULL_DETAIL):
         """
-        Retrieves the geometry for a given code and kind. If kind is '5', it computes
-        the difference between urban_rural and urban geometries.
+        Retrieves the geometry for a given code and kind. Geometries of kind '5'
+        are stored in the database too, see store_rural_areas, and computed for databases
+        built before.
 
         Args:
             shorter_code (str): The shorter code to get the geometry for.
             kind (str): The type of geometry to retrieve.
+            level (int): The level of detail, see LOD_TOLERANCES.
 
         Returns:
             QgsGeometry: The resulting geometry or None if not found.
         """
-        urban = None
+        return self._get_geometry(shorter_code, kind, level)
 
-        if kind == '5':
-            urban = self._get_geometry(shorter_code, '4')
-            if not urban:
-                return None
-            
-        actual_kind = kind if kind != '5' else '3'
-        geometry = self._get_geometry(shorter_code, actual_kind)
-        if not geometry:
-            return None
+    def geometries_from_codes(self, conn, codes, level=FULL_DETAIL):
+        """
+        Retrieves the geometries of many units. Geometries that are not in the session cache
+        are loaded with one query, the codes are passed as a JSON array and joined with the geometries.
+        Full resolution geometries of a database built with the topology are assembled from its arcs.
 
-        if kind == '5':
-            return geometry.difference(urban)
-        return geometry       
+        Args:
+            conn (sqlite3.Connection): Connection to the database.
+            codes (list): Tuples (shorter_code, kind).
+            level (int): The level of detail, see LOD_TOLERANCES.
+
+        Returns:
+            dict: Mapping of (shorter_code, kind) to QgsGeometry, codes not found are missing.
+        """
+        cache = GeometryCache.instance()
+        result = {}
+        missing = set()
+        for key in codes:
+            geometry = cache.get(key + (level,))
+            if geometry is not None:
+                result[key] = geometry
+            else:
+                missing.add(key)
+        if not missing:
+            return result
+
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT g.code, g.type, g.geometry
+            FROM json_each(?) AS c
+            JOIN {_source(level)} AS g ON g.code = json_extract(c.value, '$[0]') AND g.type = json_extract(c.value, '$[1]')
+        """, (json.dumps(sorted(missing)),))
+        in_topology = []
+        for code, kind, wkb in cursor.fetchall():
+            if wkb is None:
+                in_topology.append((code, kind))
+            else:
+                result[(code, kind)] = self._decode((code, kind, level), wkb)
+        if in_topology:
+            for key, wkb in Topology().geometries(conn, in_topology).items():
+                result[key] = self._decode(key + (level,), wkb)
+        rural = [code for code, kind in missing if kind == '5' and (code, kind) not in result]
+        if rural:
+            result.update(self._rural_geometries(conn, rural, level))
+        return result
+
+    def _rural_geometries(self, conn, codes, level):
+        # a database built before the rural areas were stored, they are computed as
+        # the urban-rural commune without its city, in the thread loading the units
+        from qgis.core import QgsGeometry
+        communes = self.geometries_from_codes(conn, [(code, kind) for code in codes for kind in ('3', '4')], level)
+        result = {}
+        for code in codes:
+            urban_rural, urban = communes.get((code, '3')), communes.get((code, '4'))
+            if urban_rural is None or urban is None:
+                continue
+            rural = urban_rural.difference(urban)
+            GeometryCache.instance().put((code, '5', level), rural, len(rural.asWkb()))
+            result[(code, '5')] = QgsGeometry(rural)
+        return result
+
+    def has_level(self, level, path=DB_PATH):
+        """
+        Tells whether the database has the geometries of a level of detail.
+
+        Args:
+            level (int): The level of detail.
+            path (str): Path of the database file.
+
+        Returns:
+            bool: True if the level has geometries, the full resolution always has them.
+        """
+        return level == FULL_DETAIL or GeoPackage().table(level, path) is not None
+
+    def is_current(self, path=DB_PATH):
+        """
+        Tells whether the database has the tables derived from the geometries. They are computed
+        when the geometries are built and shipped with the database, a file downloaded before
+        they were added still works and is offered to be downloaded again.
+
+        Args:
+            path (str): Path of the database file.
+
+        Returns:
+            bool: True if the derived tables are there.
+        """
+        with reader(path) as conn:
+            if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='geometries';").fetchone() is None:
+                return False
+            if conn.execute("SELECT 1 FROM geometries WHERE type = '5' LIMIT 1").fetchone() is None:
+                return False
+        return all(self.has_level(level, path) for level in LOD_TOLERANCES)
+
+    def _rural_areas(self, rows):
+        # the rural area of an urban-rural commune is the commune without its city
+        from shapely import wkb
+        for code, urban_rural, urban in rows:
+            rural = wkb.loads(bytes(urban_rural)).difference(wkb.loads(bytes(urban)))
+            if not rural.is_empty:
+                yield code, '5', rural.wkb
+
+    def store_rural_areas(self, conn):
+        """
+        Computes the geometries of rural areas (kind '5') of urban-rural communes that
+        do not have one yet and stores them in the geometries table, so they are read
+        like any other geometry instead of being computed on every extract.
+
+        Args:
+            conn (sqlite3.Connection): Writer connection to the database.
+
+        Returns:
+            int: The number of stored geometries.
+        """
+        rows = conn.execute("""
+            SELECT u.code, u.geometry, c.geometry
+            FROM geometries AS u
+            JOIN geometries AS c ON c.code = u.code AND c.type = '4'
+            WHERE u.type = '3' AND u.geometry IS NOT NULL AND c.geometry IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM geometries AS r WHERE r.code = u.code AND r.type = '5')
+        """).fetchall()
+        rural_areas = list(self._rural_areas(rows))
+        conn.executemany("INSERT INTO geometries (code, type, geometry) VALUES (?, ?, ?)", rural_areas)
+        return len(rural_areas)
+
+    def store_simplified(self, conn):
+        """
+        Stores the simplified geometries of every level of LOD_TOLERANCES in the GeoPackage
+        table of the level, replacing the previous ones. They are assembled from the arcs of the
+        topology simplified once, see Topology.simplified.
+
+        Args:
+            conn (sqlite3.Connection): Writer connection to the database with the topology built.
+
+        Returns:
+            int: The number of stored geometries.
+        """
+        levels = {level: [] for level in LOD_TOLERANCES}
+        for code, kind, level, wkb in Topology().simplified(conn, LOD_TOLERANCES):
+            levels[level].append((code, kind, wkb))
+        for level, rows in levels.items():
+            GeoPackage().build(conn, level, rows)
+        return sum(len(rows) for rows in levels.values())
 
     def _fetch_commune_geometries(self):
         layer_name = 'ms:A03_Granice_gmin'
@@ -104,7 +329,7 @@ class Geometry(object):
             'outputFormat': 'application/gml+xml; version=3.2',
 
         }
-        response = requests.get(wfs_url, params=params)
+        response = BDLClient.instance().get(wfs_url, params=params, timeout=(CONNECT_TIMEOUT, WFS_READ_TIMEOUT))
 
         if response.status_code != 200:
             print('Failed to fetch geometries')
@@ -141,7 +366,7 @@ class Geometry(object):
             'outputFormat': 'application/gml+xml; version=3.2',
 
         }
-        response = requests.get(wfs_url, params=params)
+        response = BDLClient.instance().get(wfs_url, params=params, timeout=(CONNECT_TIMEOUT, WFS_READ_TIMEOUT))
 
         if response.status_code != 200:
             print('Failed to fetch geometries')
@@ -177,10 +402,18 @@ class Geometry(object):
         # Usuń duplikaty na podstawie 'code' i 'type', zachowując pierwsze wystąpienie (z 'communes')
         combined_gdf = combined_gdf.drop_duplicates(subset=['code', 'type'], keep='first')
 
-        with sqlite3.connect(DB_PATH) as conn:
-            combined_gdf.to_sql('geometries', conn, if_exists='replace', index=False)    
-            # Utwórz indeks na kolumnie 'code'
-            conn.execute("CREATE INDEX idx_code ON geometries (code);")
-
-        # Utwórz unikalny indeks na parze 'code' i 'type'
-            conn.execute("CREATE UNIQUE INDEX idx_code_type ON geometries (code, type);")
\ No newline at end of file
+        with writer() as conn:
+            combined_gdf.to_sql('geometries', conn, if_exists='replace', index=False)
+            self.store_rural_areas(conn)
+            index_geometries(conn)
+            create_topology(conn)
+            Topology().build(conn)
+            # the full resolution table is built again from the arcs on the user machine
+            GeoPackage().drop_all(conn)
+            self.store_simplified(conn)
+            # full resolution geometries are kept only as shared arcs, the rows stay for lookups of units
+            conn.execute("UPDATE geometries SET geometry = NULL;")
+        # give the space of the dropped blobs back, VACUUM cannot run inside the transaction above
+        with writer() as conn:
+            conn.execute("VACUUM;")
+        GeometryCache.instance().clear()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import struct
+import numpy as np
+from ..config import DB_PATH
+from .database import reader, writer
+
+GPKG_APPLICATION_ID = 0x47504B47  # "GPKG" in the database header, how OGR recognises a GeoPackage
+GPKG_VERSION = 10200  # PRAGMA user_version of a GeoPackage 1.2 file
+SRS_ID = 2180
+SRS_DEFINITION = (
+    'PROJCS["ETRF2000-PL / CS92",GEOGCS["ETRF2000-PL",DATUM["ETRF2000_Poland",'
+    'SPHEROID["GRS 1980",6378137,298.257222101]],PRIMEM["Greenwich",0],'
+    'UNIT["degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],'
+    'PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",19],'
+    'PARAMETER["scale_factor",0.9993],PARAMETER["false_easting",500000],'
+    'PARAMETER["false_northing",-5300000],UNIT["metre",1],AUTHORITY["EPSG","2180"]]'
+)
+_GPKG_FLAGS = 0b011  # little endian header with an [minx, maxx, miny, maxy] envelope
+GPKG_HEADER_SIZE = 40  # bytes of the header written with _GPKG_FLAGS, the WKB follows it
+BUILD_CHUNK_SIZE = 500  # units written in one transaction when the full resolution table is built
+
+_WKB_MULTIPOLYGON = 6
+
+
+def table_name(level):
+    """
+    Returns the name of the feature table with the geometries of a level of detail.
+    """
+    return f"units_{int(level)}"
+
+
+def create_core(conn):
+    """
+    Creates the tables every GeoPackage has and marks the file as a GeoPackage.
+    The other tables of the database are not listed in gpkg_contents, so OGR does not see them.
+    PRAGMA user_version holds the GeoPackage version, the schema version is kept in its own table.
+    """
+    conn.execute(f"PRAGMA application_id = {GPKG_APPLICATION_ID}")
+    conn.execute(f"PRAGMA user_version = {GPKG_VERSION}")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+            srs_name TEXT NOT NULL,
+            srs_id INTEGER NOT NULL PRIMARY KEY,
+            organization TEXT NOT NULL,
+            organization_coordsys_id INTEGER NOT NULL,
+            definition TEXT NOT NULL,
+            description TEXT
+        );
+    """)
+    conn.executemany("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", [
+        ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+        ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+        ("ETRF2000-PL / CS92", SRS_ID, "EPSG", SRS_ID, SRS_DEFINITION, None),
+    ])
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS gpkg_contents (
+            table_name TEXT NOT NULL PRIMARY KEY,
+            data_type TEXT NOT NULL,
+            identifier TEXT UNIQUE,
+            description TEXT DEFAULT '',
+            last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+            min_x DOUBLE,
+            min_y DOUBLE,
+            max_x DOUBLE,
+            max_y DOUBLE,
+            srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id)
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+            table_name TEXT NOT NULL,
+            column_name TEXT NOT NULL,
+            geometry_type_name TEXT NOT NULL,
+            srs_id INTEGER NOT NULL,
+            z TINYINT NOT NULL,
+            m TINYINT NOT NULL,
+            PRIMARY KEY (table_name, column_name)
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS gpkg_extensions (
+            table_name TEXT,
+            column_name TEXT,
+            extension_name TEXT NOT NULL,
+            definition TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            UNIQUE (table_name, column_name, extension_name)
+        );
+    """)
+
+
+def _wkb_type(wkb, offset=0):
+    # byte order, base geometry type and number of coordinates per point of a WKB geometry
+    order = '<' if wkb[offset] == 1 else '>'
+    kind, = struct.unpack_from(order + 'I', wkb, offset + 1)
+    iso = (kind & 0xFFFF) // 1000
+    dimensions = 2 + (bool(kind & 0x80000000) or iso in (1, 3)) + (bool(kind & 0x40000000) or iso in (2, 3))
+    return order, kind, (kind & 0xFFFF) % 1000, dimensions
+
+
+def _bounds(wkb):
+    # (min_x, min_y, max_x, max_y) of a Polygon or MultiPolygon WKB
+    x, y = [], []
+
+    def polygon(offset):
+        order, _kind, _base, dimensions = _wkb_type(wkb, offset)
+        offset += 5
+        rings, = struct.unpack_from(order + 'I', wkb, offset)
+        offset += 4
+        for _ring in range(rings):
+            count, = struct.unpack_from(order + 'I', wkb, offset)
+            offset += 4
+            points = np.frombuffer(wkb, dtype=order + 'f8', count=count * dimensions, offset=offset).reshape(-1, dimensions)
+            x.append(points[:, 0])
+            y.append(points[:, 1])
+            offset += count * dimensions * 8
+        return offset
+
+    order, _kind, base, _dimensions = _wkb_type(wkb)
+    if base == _WKB_MULTIPOLYGON:
+        parts, = struct.unpack_from(order + 'I', wkb, 5)
+        offset = 9
+        for _part in range(parts):
+            offset = polygon(offset)
+    else:
+        polygon(0)
+    if not x:
+        return None
+    x, y = np.concatenate(x), np.concatenate(y)
+    return float(x.min()), float(y.min()), float(x.max()), float(y.max())
+
+
+def _gpkg_geometry(wkb):
+    # GeoPackage geometry: header with the envelope followed by the WKB of a MultiPolygon
+    wkb = bytes(wkb)
+    bounds = _bounds(wkb)
+    if bounds is None:
+        return None, None
+    _order, kind, base, _dimensions = _wkb_type(wkb)
+    if base != _WKB_MULTIPOLYGON:
+        # a MultiPolygon of the one polygon with its dimensions, the part keeps its own byte order
+        wkb = struct.pack('<BII', 1, kind - base + _WKB_MULTIPOLYGON, 1) + wkb
+    min_x, min_y, max_x, max_y = bounds
+    header = struct.pack('<2sBBi4d', b'GP', 0, _GPKG_FLAGS, SRS_ID, min_x, max_x, min_y, max_y)
+    return header + wkb, bounds
+
+
+def _union(extent, bounds):
+    if bounds is None:
+        return extent
+    if extent is None:
+        return bounds
+    return (
+        min(extent[0], bounds[0]), min(extent[1], bounds[1]),
+        max(extent[2], bounds[2]), max(extent[3], bounds[3])
+    )
+
+
+class GeoPackage(object):
+    """
+    Feature tables of data.sqlite in the GeoPackage format with an R-tree spatial index,
+    one per level of detail, so QGIS reads the geometries through OGR without copying them
+    through Python. The simplified levels are stored only in these tables, they are built
+    with the geometries and shipped with the database. The full resolution is shipped as
+    the arcs of the topology, its table is built on the user machine the first time a layer
+    reads the geometries from the database. The tables are not written afterwards, so the
+    R-tree maintenance triggers are not created and layers using them are read-only.
+    """
+
+    def create(self, conn, name):
+        """
+        Creates an empty feature table with its R-tree index, replacing the previous one.
+        The table is not registered, OGR does not see it until register is called.
+        """
+        create_core(conn)
+        self.drop(conn, name)
+        conn.execute(f"""
+            CREATE TABLE {name} (
+                fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                geom MULTIPOLYGON,
+                unit TEXT NOT NULL, -- short code and kind, the key the fetched attributes are joined by
+                short_code TEXT NOT NULL,
+                type TEXT NOT NULL
+            );
+        """)
+        conn.execute(f"CREATE UNIQUE INDEX {name}_unit_idx ON {name} (unit);")
+        # simplified geometries are looked up by code, see geometry._source
+        conn.execute(f"CREATE INDEX {name}_code_idx ON {name} (short_code, type);")
+        conn.execute(f"CREATE VIRTUAL TABLE rtree_{name}_geom USING rtree(id, minx, maxx, miny, maxy);")
+
+    def insert(self, conn, name, rows):
+        """
+        Adds geometries to a feature table.
+
+        Args:
+            conn (sqlite3.Connection): Writer connection to the database.
+            name (str): Name of the feature table.
+            rows (iterable): Tuples (shorter_code, kind, wkb) of Polygon or MultiPolygon WKB.
+
+        Returns:
+            tuple: The extent (min_x, min_y, max_x, max_y) of the added geometries or None.
+        """
+        extent = None
+        for code, kind, wkb in rows:
+            geometry, bounds = _gpkg_geometry(wkb)
+            if geometry is None:
+                continue
+            fid = conn.execute(
+                f"INSERT INTO {name} (geom, unit, short_code, type) VALUES (?, ?, ?, ?)",
+                (geometry, code + kind, code, kind)
+            ).lastrowid
+            conn.execute(
+                f"INSERT INTO rtree_{name}_geom (id, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)",
+                (fid, bounds[0], bounds[2], bounds[1], bounds[3])
+            )
+            extent = _union(extent, bounds)
+        return extent
+
+    def register(self, conn, name, extent):
+        """
+        Lists a filled feature table in the GeoPackage tables, so OGR reads it.
+        """
+        extent = extent or (None, None, None, None)
+        conn.execute("""
+            INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id)
+            VALUES (?, 'features', ?, ?, ?, ?, ?, ?)
+        """, (name, name) + tuple(extent) + (SRS_ID,))
+        conn.execute(
+            "INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'MULTIPOLYGON', ?, 0, 0)",
+            (name, SRS_ID)
+        )
+        conn.execute(
+            "INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+            (name,)
+        )
+
+    def build(self, conn, level, rows):
+        """
+        Creates the feature table of a level of detail in one transaction, used when the
+        geometries are built.
+
+        Args:
+            conn (sqlite3.Connection): Writer connection to the database.
+            level (int): The level of detail.
+            rows (iterable): Tuples (shorter_code, kind, wkb).
+
+        Returns:
+            str: Name of the feature table.
+        """
+        name = table_name(level)
+        self.create(conn, name)
+        self.register(conn, name, self.insert(conn, name, rows))
+        return name
+
+    def build_full_detail(self, progress=None, stopped=None, path=DB_PATH):
+        """
+        Creates the feature table of the full resolution geometries on the user machine.
+        The geometries are written in chunks of BUILD_CHUNK_SIZE units, each in its own
+        short transaction, and the table is registered when all of them are there.
+
+        Args:
+            progress (callable): Called with the percentage of the units written.
+            stopped (callable): Returns True when the build has to stop.
+            path (str): Path of the database file.
+
+        Returns:
+            str: Name of the feature table or None if the build was stopped.
+        """
+        from .geometry import Geometry, FULL_DETAIL
+        name = table_name(FULL_DETAIL)
+        with reader(path) as conn:
+            # rural areas missing from an older database are computed, see Geometry.geometries_from_codes
+            codes = conn.execute("""
+                SELECT code, type FROM geometries
+                UNION SELECT code, '5' FROM geometries WHERE type = '3'
+            """).fetchall()
+        with writer(path) as conn:
+            self.create(conn, name)
+
+        extent = None
+        geometry = Geometry()
+        for start in range(0, len(codes), BUILD_CHUNK_SIZE):
+            if stopped is not None and stopped():
+                return None
+            with reader(path) as conn:
+                geometries = geometry.geometries_from_codes(conn, codes[start:start + BUILD_CHUNK_SIZE])
+            rows = [(code, kind, bytes(item.asWkb())) for (code, kind), item in geometries.items() if not item.isEmpty()]
+            with writer(path) as conn:
+                extent = _union(extent, self.insert(conn, name, rows))
+            if progress is not None:
+                progress(int(min(start + BUILD_CHUNK_SIZE, len(codes)) / len(codes) * 100))
+
+        with writer(path) as conn:
+            self.register(conn, name, extent)
+        return name
+
+    def drop(self, conn, name):
+        """
+        Drops a feature table with its index and its GeoPackage registration.
+        """
+        conn.execute(f"DROP TABLE IF EXISTS rtree_{name}_geom;")
+        conn.execute(f"DROP TABLE IF EXISTS {name};")
+        for table in ("gpkg_contents", "gpkg_geometry_columns", "gpkg_extensions"):
+            conn.execute(f"DELETE FROM {table} WHERE table_name = ?", (name,))
+
+    def drop_all(self, conn):
+        """
+        Drops the feature tables of every level, used before the geometries are rebuilt.
+        """
+        if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='gpkg_contents';").fetchone() is None:
+            return
+        for (name,) in conn.execute("SELECT table_name FROM gpkg_contents WHERE data_type = 'features'").fetchall():
+            self.drop(conn, name)
+
+    def table(self, level, path=DB_PATH):
+        """
+        Returns the feature table of a level of detail.
+
+        Args:
+            level (int): The level of detail.
+            path (str): Path of the database file.
+
+        Returns:
+            str: Name of the feature table or None if the database does not have it.
+        """
+        name = table_name(level)
+        with reader(path) as conn:
+            if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='gpkg_contents';").fetchone() is None:
+                return None
+            if conn.execute("SELECT 1 FROM gpkg_contents WHERE table_name = ?", (name,)).fetchone() is None:
+                return None
+        return name
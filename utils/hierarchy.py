@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import sys
+import threading
+from array import array
+from ..config import DB_PATH
+from .database import reader
+
+LANGUAGES = ("pl", "en")
+NO_PARENT = -1
+FINEST_LEVEL = 6
+
+# Lengths of the code prefix shared by all descendants of a unit, finest level last.
+# Full code layout: region(2) voivodeship(2) area(1) subregion(2) county(2) commune(2) kind(1)
+PREFIX_LENGTHS = (2, 4, 5, 7, 9)
+COMMUNE_PREFIX_LENGTH = 11
+
+
+def unit_prefix(full_code):
+    """
+    Returns the part of the unit code shared by the unit and all its descendants.
+
+    Args:
+        full_code (str): The full unit code.
+
+    Returns:
+        str: The code prefix.
+    """
+    for length in PREFIX_LENGTHS:
+        if full_code[length:].strip('0') == '':
+            return full_code[:length]
+    # communes: children of urban-rural communes differ only by kind
+    return full_code[:COMMUNE_PREFIX_LENGTH]
+
+
+class TerytIndex(object):
+    """
+    In-memory index of the TERYT hierarchy, loaded once per QGIS session and shared by
+    the units tree, the Expander and the name lookups. Units are numbered by their position
+    in the index. Parents are kept in an array, children in one array of positions with
+    per-unit offsets into it, and names are interned strings per language.
+    The index is read-only once loaded and can be used from any thread.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the index shared by the whole QGIS session, loading it on first use.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def reset(cls):
+        """
+        Drops the shared index, the next call to instance() loads it again.
+        Used after the database file was replaced.
+        """
+        with cls._instance_lock:
+            cls._instance = None
+
+    def __init__(self, path=DB_PATH):
+        with reader(path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT full_code, short_code, parent_code, name, kind, level, language
+                FROM teryt_codes
+                ORDER BY full_code
+            """)
+            rows = cursor.fetchall()
+            cursor.execute("SELECT code, type FROM geometries")
+            with_geometry = set(cursor.fetchall())
+
+        self.full_codes = []
+        self.short_codes = []
+        self.kinds = []
+        self.levels = array('b')
+        self.position = {}  # {full_code: position}
+        self.names = {language: [] for language in LANGUAGES}
+        parent_codes = []
+
+        for full_code, short_code, parent_code, name, kind, level, language in rows:
+            position = self.position.get(full_code)
+            if position is None:
+                position = len(self.full_codes)
+                self.position[full_code] = position
+                self.full_codes.append(sys.intern(full_code))
+                self.short_codes.append(sys.intern(short_code or ''))
+                self.kinds.append(sys.intern(kind or ''))
+                self.levels.append(int(level))
+                parent_codes.append(parent_code)
+                for names in self.names.values():
+                    names.append(None)
+            if language in self.names:
+                self.names[language][position] = sys.intern(name)
+
+        count = len(self.full_codes)
+        self.parents = array('i', (self.position.get(code, NO_PARENT) if code else NO_PARENT for code in parent_codes))
+
+        # children of unit i are child_positions[child_offsets[i]:child_offsets[i + 1]], in code order
+        counts = [0] * (count + 1)
+        for parent in self.parents:
+            if parent != NO_PARENT:
+                counts[parent + 1] += 1
+        self.child_offsets = array('i', [0] * (count + 1))
+        for i in range(count):
+            self.child_offsets[i + 1] = self.child_offsets[i] + counts[i + 1]
+        self.child_positions = array('i', [0] * self.child_offsets[count])
+        filled = array('i', self.child_offsets[:count])
+        for position, parent in enumerate(self.parents):
+            if parent != NO_PARENT:
+                self.child_positions[filled[parent]] = position
+                filled[parent] += 1
+
+        # (short_code, kind) identifies a unit in names and geometries
+        self.by_short_code = {}
+        for position in range(count):
+            self.by_short_code.setdefault((self.short_codes[position], self.kinds[position]), position)
+
+        # finest units below each code prefix, see unit_prefix
+        self.leaf_counts = {}  # {prefix: count}
+        for position in range(count):
+            if self.levels[position] == FINEST_LEVEL:
+                full_code = self.full_codes[position]
+                for length in PREFIX_LENGTHS + (COMMUNE_PREFIX_LENGTH,):
+                    prefix = full_code[:length]
+                    self.leaf_counts[prefix] = self.leaf_counts.get(prefix, 0) + 1
+
+        # communes of each county that have a geometry, see Expander._expand_county
+        self.county_communes = {}  # {voivodeship + county: [position]}
+        for position in range(count):
+            short_code, kind = self.short_codes[position], self.kinds[position]
+            if kind in ('1', '2', '3') and (short_code, kind) in with_geometry:
+                self.county_communes.setdefault(short_code[:4], []).append(position)
+
+    def _row(self, position, lang):
+        return (
+            self.full_codes[position],
+            self.names[lang][position],
+            self.kinds[position],
+            self.levels[position]
+        )
+
+    def children(self, full_code, lang):
+        """
+        Returns the children of a unit by parent code.
+
+        Returns:
+            list: Tuples (full_code, name, kind, level), empty for unknown codes.
+        """
+        position = self.position.get(full_code)
+        if position is None:
+            return []
+        start, end = self.child_offsets[position], self.child_offsets[position + 1]
+        return [self._row(child, lang) for child in self.child_positions[start:end]]
+
+    def parent(self, full_code):
+        """
+        Returns the full code of the parent of a unit.
+
+        Returns:
+            str: The parent code or None for top level and unknown units.
+        """
+        position = self.position.get(full_code)
+        if position is None or self.parents[position] == NO_PARENT:
+            return None
+        return self.full_codes[self.parents[position]]
+
+    def leaf_count(self, full_code):
+        """
+        Returns the number of the finest units sharing the code prefix of a unit,
+        the units returned by a by-variable query with the unit as unit-parent-id.
+        """
+        return self.leaf_counts.get(unit_prefix(full_code), 0)
+
+    def communes_of_county(self, full_code, lang):
+        """
+        Returns the communes of a county that have a geometry.
+
+        Returns:
+            list: Tuples (full_code, name, kind, level).
+        """
+        return [self._row(position, lang) for position in self.county_communes.get(full_code[2:4] + full_code[7:9], [])]
+
+    def units(self, level, lang):
+        """
+        Returns all units of a level.
+
+        Returns:
+            list: Tuples (full_code, short_code, name, kind, level) in code order.
+        """
+        return [
+            (self.full_codes[position], self.short_codes[position], self.names[lang][position], self.kinds[position], level)
+            for position in range(len(self.full_codes))
+            if self.levels[position] == level
+        ]
+
+    def name(self, shorter_code, kind, lang):
+        """
+        Returns the name of a unit.
+
+        Args:
+            shorter_code (str): The shorter code of the unit without type.
+            kind (str): The kind of the unit.
+            lang (str): The language code to get the name in.
+
+        Returns:
+            str: The name or None if the unit is not known.
+        """
+        position = self.by_short_code.get((shorter_code, kind))
+        if position is None:
+            return None
+        return self.names[lang][position]
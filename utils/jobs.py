@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import json
+import time
+from ..config import CACHE_PATH
+from .database import reader, writer
+
+
+class FetchJob(object):
+    """
+    A data fetching job persisted in the cache database: the parameters chosen by the user,
+    the planned requests with their completion status and the values already fetched.
+    A job that was interrupted can be reopened and only the missing requests are sent again.
+    """
+    def __init__(self, job_id, path=CACHE_PATH):
+        self.job_id = job_id
+        self.path = path
+
+    @classmethod
+    def create(cls, do_merge, units, variables, variables_names, years, items, detail, output, output_path, path=CACHE_PATH):
+        """
+        Stores a new job.
+
+        Args:
+            do_merge (bool): Whether rural and urban areas are merged.
+            units (list): Unit codes selected by the user.
+            variables (list): Variable IDs selected by the user.
+            variables_names (dict): Mapping of variable IDs to user-defined column names.
+            years (list): Years selected by the user.
+            items (list): Planned requests (endpoint, unit, variables), see RequestPlanner.plan.
+            detail (int): Level of detail of the geometries, None picks it from the number of units.
+            output (str): Where the layer keeps its geometries, see create_layer.
+            output_path (str): Path of the GeoPackage file of a file output, None for the others.
+
+        Returns:
+            FetchJob: The new job.
+        """
+        with writer(path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO fetch_jobs (created_at, do_merge, units, variables, variables_names, years, detail, output, output_path)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                int(time.time()),
+                int(bool(do_merge)),
+                json.dumps(list(units)),
+                json.dumps(list(variables)),
+                json.dumps(dict(variables_names)),
+                json.dumps(list(years)),
+                detail,
+                output,
+                output_path
+            ))
+            job_id = cursor.lastrowid
+            cursor.executemany("""
+                INSERT INTO fetch_job_items (job_id, item_index, endpoint, unit, variables)
+                VALUES (?, ?, ?, ?, ?)
+            """, [
+                (job_id, index, endpoint, unit, ",".join(item_variables))
+                for index, (endpoint, unit, item_variables) in enumerate(items)
+            ])
+        return cls(job_id, path)
+
+    @staticmethod
+    def unfinished(path=CACHE_PATH):
+        """
+        Returns the parameters of the most recent unfinished job.
+
+        Returns:
+            dict: Keys job_id, do_merge, units, variables, variables_names, years, detail,
+            output and output_path, or None if there is no unfinished job.
+        """
+        with writer(path) as conn:
+            row = conn.execute("""
+                SELECT id, do_merge, units, variables, variables_names, years, detail, output, output_path
+                FROM fetch_jobs
+                ORDER BY id DESC LIMIT 1
+            """).fetchone()
+        if row is None:
+            return None
+        job_id, do_merge, units, variables, variables_names, years, detail, output, output_path = row
+        return {
+            "job_id": job_id,
+            "do_merge": bool(do_merge),
+            "units": json.loads(units),
+            "variables": json.loads(variables),
+            "variables_names": json.loads(variables_names),
+            "years": json.loads(years),
+            "detail": detail,
+            "output": output,
+            "output_path": output_path,
+        }
+
+    @staticmethod
+    def discard(job_id, path=CACHE_PATH):
+        """
+        Removes a job with its requests and values.
+        """
+        with writer(path) as conn:
+            conn.execute("DELETE FROM fetch_job_values WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM fetch_job_items WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM fetch_jobs WHERE id = ?", (job_id,))
+
+    def items(self):
+        """
+        Returns the planned requests of the job in their merge order.
+
+        Returns:
+            list: Tuples (endpoint, unit, variables).
+        """
+        with reader(self.path) as conn:
+            rows = conn.execute("""
+                SELECT endpoint, unit, variables FROM fetch_job_items
+                WHERE job_id = ? ORDER BY item_index
+            """, (self.job_id,)).fetchall()
+        return [(endpoint, unit, tuple(variables.split(","))) for endpoint, unit, variables in rows]
+
+    def completed_items(self):
+        """
+        Returns the indices of the requests already completed.
+        """
+        with reader(self.path) as conn:
+            rows = conn.execute("""
+                SELECT item_index FROM fetch_job_items
+                WHERE job_id = ? AND completed = 1
+            """, (self.job_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def values(self):
+        """
+        Returns the values staged by the completed requests.
+
+        Returns:
+            list: Tuples (unit_id, variable_id, year, value).
+        """
+        with reader(self.path) as conn:
+            return conn.execute("""
+                SELECT unit_id, variable_id, year, value FROM fetch_job_values WHERE job_id = ?
+            """, (self.job_id,)).fetchall()
+
+    def complete_item(self, item_index, cells):
+        """
+        Marks a request as completed and stores its values in one transaction.
+
+        Args:
+            item_index (int): Index of the request in the plan.
+            cells (list): Tuples (unit_id, variable_id, year, value) staged from the request.
+        """
+        with writer(self.path) as conn:
+            conn.executemany("""
+                INSERT INTO fetch_job_values (job_id, unit_id, variable_id, year, value)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(self.job_id,) + tuple(cell) for cell in cells])
+            conn.execute("""
+                UPDATE fetch_job_items SET completed = 1 WHERE job_id = ? AND item_index = ?
+            """, (self.job_id, item_index))
+
+    def finish(self):
+        """
+        Removes the job once all its data is in the layer.
+        """
+        FetchJob.discard(self.job_id, self.path)
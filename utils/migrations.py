@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+from ..config import DB_PATH, CACHE_PATH
+from .database import writer
+from .geopackage import create_core
+
+
+def create_teryt_codes(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS teryt_codes (
+            short_code TEXT NOT NULL,
+            full_code TEXT NOT NULL,
+            parent_code TEXT,
+            name TEXT NOT NULL,
+            kind TEXT,
+            level INTEGER NOT NULL,
+            language TEXT NOT NULL
+        );
+    ''')
+    # Indexes
+    #the short code is mostly used for searching
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS teryt_codes_short_code_idx ON teryt_codes (short_code);
+    ''')
+    # we will search also by parent_code that is search for children
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS teryt_codes_parent_code_idx ON teryt_codes (parent_code);
+    ''')
+    # unique are fullcode with language
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS teryt_codes_full_code_language_idx ON teryt_codes (full_code, language);
+    ''')
+
+
+def create_subjects(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS subjects (
+            subject_code TEXT NOT NULL,
+            parent_id TEXT,
+            name TEXT NOT NULL,
+            language TEXT NOT NULL,
+            has_variables BOOLEAN,
+            children_fetched BOOLEAN DEFAULT 0 -- status for children: 0 - not fetched, 1 - fetched
+        );
+    ''')
+    # Indexes
+    #the short code is mostly used for searching
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS subjects_subject_code_idx ON subjects (subject_code);
+    ''')
+    # we will search also by parent_id
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS subjects_parent_id_idx ON subjects (parent_id);
+    ''')
+    # unique are subject_code with language
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS subjects_subject_code_language_idx ON subjects (subject_code, language);
+    ''')
+
+
+def create_variables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS variables (
+            id INTEGER,
+            subject_id TEXT,
+            n1 TEXT,
+            n2 TEXT,
+            n3 TEXT,
+            n4 TEXT,
+            n5 TEXT,
+            language TEXT NOT NULL,
+            level INTEGER,
+            measure_unit_id INTEGER,
+            measure_unit_name TEXT
+        );
+    ''')
+    # Indexes
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS variables_subject_id_idx ON variables (subject_id);
+    ''')
+    # unique are id with language
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS variables_id_language_idx ON variables (id, language);
+    ''')
+
+
+def create_tokens(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS tokens (
+                        token TEXT PRIMARY KEY,
+                        last_failed_time INTEGER
+                 );""")
+
+
+def index_geometries(conn):
+    # the geometries table is written by Geometry._fetch_geometries, index it only when it is there
+    if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='geometries';").fetchone() is None:
+        return
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_code ON geometries (code);")
+    # Create a unique index on the pair 'code' and 'type'
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_code_type ON geometries (code, type);")
+
+
+def create_topology(conn):
+    # geometries as shared arcs, see Topology
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS topology_arcs (
+            id INTEGER PRIMARY KEY,
+            points BLOB NOT NULL -- zlib compressed int32 deltas of the points
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS topology_units (
+            code TEXT NOT NULL,
+            type TEXT NOT NULL,
+            arcs TEXT NOT NULL, -- JSON polygons of rings of arc references
+            PRIMARY KEY (code, type)
+        );
+    """)
+    # the grid of the arcs
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS topology_transform (
+            step REAL NOT NULL,
+            translate_x REAL NOT NULL,
+            translate_y REAL NOT NULL
+        );
+    """)
+
+
+def create_responses(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS responses (
+            endpoint TEXT NOT NULL, -- by-variable or by-unit
+            variables TEXT NOT NULL, -- comma separated variable IDs
+            years TEXT NOT NULL, -- comma separated years of the filter, empty for every year
+            unit TEXT NOT NULL, -- unit-parent-id of by-variable, the unit of by-unit
+            unit_level INTEGER NOT NULL,
+            page INTEGER NOT NULL,
+            language TEXT NOT NULL,
+            body BLOB NOT NULL, -- zlib compressed JSON
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at INTEGER NOT NULL,
+            accessed_at INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (endpoint, variables, years, unit, unit_level, page, language)
+        );
+    """)
+    # eviction goes through the least recently used rows
+    conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at_idx ON responses (accessed_at);")
+
+
+def create_fetch_jobs(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fetch_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER NOT NULL,
+            do_merge INTEGER NOT NULL,
+            units TEXT NOT NULL, -- JSON list
+            variables TEXT NOT NULL, -- JSON list
+            variables_names TEXT NOT NULL, -- JSON object
+            years TEXT NOT NULL -- JSON list
+        );
+    """)
+    # planned requests of a job, in the order their results are merged
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fetch_job_items (
+            job_id INTEGER NOT NULL,
+            item_index INTEGER NOT NULL,
+            endpoint TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            variables TEXT NOT NULL, -- comma separated variable IDs
+            completed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (job_id, item_index)
+        );
+    """)
+    # values staged by the completed requests
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fetch_job_values (
+            job_id INTEGER NOT NULL,
+            unit_id TEXT NOT NULL,
+            variable_id TEXT NOT NULL,
+            year TEXT NOT NULL,
+            value REAL NOT NULL
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS fetch_job_values_job_id_idx ON fetch_job_values (job_id);")
+
+
+def _data_schema_1(conn):
+    create_teryt_codes(conn)
+    create_subjects(conn)
+    create_variables(conn)
+    create_tokens(conn)
+    index_geometries(conn)
+
+
+def _data_schema_2(conn):
+    # rural areas (kind 5) are stored when the geometries are built, see Geometry._fetch_geometries,
+    # a database without them is downloaded again, see Geometry.is_current
+    pass
+
+
+def _data_schema_3(conn):
+    # simplified geometries are kept in the GeoPackage tables, see _data_schema_7
+    pass
+
+
+def _data_schema_4(conn):
+    # the topology is filled when the geometries are built, see Geometry._fetch_geometries
+    create_topology(conn)
+
+
+def _data_schema_5(conn):
+    # data.sqlite is a GeoPackage, its feature tables are built with the geometries, see Geometry._fetch_geometries
+    create_core(conn)
+
+
+def _data_schema_6(conn):
+    # the schema version moved to its own table, user_version is the GeoPackage version again
+    create_core(conn)
+
+
+def _data_schema_7(conn):
+    # the simplified geometries moved to the GeoPackage tables of their levels
+    conn.execute("DROP TABLE IF EXISTS geometries_lod;")
+
+
+def _cache_schema_1(conn):
+    create_responses(conn)
+    create_fetch_jobs(conn)
+
+
+def _cache_schema_2(conn):
+    # how the layer of a job is written, so a resumed job writes it the same way
+    conn.execute("ALTER TABLE fetch_jobs ADD COLUMN detail INTEGER;")  # NULL picks the level from the number of units
+    conn.execute("ALTER TABLE fetch_jobs ADD COLUMN output TEXT NOT NULL DEFAULT 'memory';")
+    conn.execute("ALTER TABLE fetch_jobs ADD COLUMN output_path TEXT;")  # the GeoPackage file of a file output
+
+
+def _cache_schema_3(conn):
+    # the request was packed into the variable column, the cached responses are dropped
+    # and fetched again under a key with a column for each part of the request
+    conn.execute("DROP TABLE IF EXISTS responses;")
+    create_responses(conn)
+
+
+# Migrations of each database file as (version, step), in the order they are applied.
+# A step brings the schema from the previous version to its version, add new steps at the end.
+DATA_MIGRATIONS = [
+    (1, _data_schema_1),
+    (2, _data_schema_2),
+    (3, _data_schema_3),
+    (4, _data_schema_4),
+    (5, _data_schema_5),
+    (6, _data_schema_6),
+    (7, _data_schema_7),
+]
+CACHE_MIGRATIONS = [
+    (1, _cache_schema_1),
+    (2, _cache_schema_2),
+    (3, _cache_schema_3),
+]
+
+
+def _schema_version(conn):
+    if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version';").fetchone() is None:
+        # files migrated before the table was added kept the version in PRAGMA user_version
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    row = conn.execute("SELECT version FROM schema_version").fetchone()
+    return row[0] if row else 0
+
+
+def _set_schema_version(conn, version):
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL);")
+    conn.execute("DELETE FROM schema_version;")
+    conn.execute("INSERT INTO schema_version (version) VALUES (?)", (int(version),))
+
+
+def migrate(path, migrations):
+    """
+    Brings the schema of a database file up to date. The version of the schema is kept
+    in the schema_version table, PRAGMA user_version of data.sqlite is taken by the GeoPackage
+    format. Only the steps newer than the version are applied, each in its own transaction
+    together with the new version, an up to date file is only read.
+
+    Args:
+        path (str): Path of the database file.
+        migrations (list): Tuples (version, step) of the file.
+
+    Returns:
+        int: The schema version after the migration.
+    """
+    with writer(path) as conn:
+        version = _schema_version(conn)
+    for step_version, step in migrations:
+        if step_version <= version:
+            continue
+        with writer(path) as conn:
+            # sqlite3 opens transactions only before DML, a step failing halfway
+            # through its DDL would be left half applied without an explicit one
+            conn.execute("BEGIN")
+            step(conn)
+            _set_schema_version(conn, step_version)
+        version = step_version
+    return version
+
+
+def migrate_all():
+    """
+    Migrates data.sqlite and the cache file. Run once at plugin start, before any other
+    database access, so the classes using the tables do not have to create them.
+    """
+    migrate(DB_PATH, DATA_MIGRATIONS)
+    migrate(CACHE_PATH, CACHE_MIGRATIONS)
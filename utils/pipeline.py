@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import queue
+import threading
+import time
+
+STOP = object()  # put into a queue after the last item of a stage
+
+POLL_INTERVAL = 0.1  # seconds between checks whether a blocked stage should give up
+
+
+class StageCounters(object):
+    """
+    Throughput counters of a pipeline stage: the items it processed, the time spent working
+    on them and the time it was blocked by a full queue of the next stage (backpressure).
+    Safe to update from many threads of one stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0  # seconds spent processing items
+        self.blocked = 0.0  # seconds spent waiting for room in the next queue
+        self.started = time.monotonic()
+
+    def processed(self, items, seconds):
+        """
+        Records items processed in the given time.
+        """
+        with self.lock:
+            self.items += items
+            self.busy += seconds
+
+    def waited(self, seconds):
+        """
+        Records time the stage was blocked by the next stage.
+        """
+        with self.lock:
+            self.blocked += seconds
+
+    def throughput(self):
+        """
+        Returns the items processed per second since the stage was created.
+        """
+        elapsed = time.monotonic() - self.started
+        return self.items / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.name}: {self.items} items, {self.throughput():.1f}/s, busy {self.busy:.1f}s, blocked {self.blocked:.1f}s"
+
+
+def put(target, item, counters, stopped):
+    """
+    Puts an item into a bounded queue, waiting while the queue is full.
+    The waiting time is recorded as backpressure of the stage.
+
+    Args:
+        target (queue.Queue): The queue of the next stage.
+        item: The item to put.
+        counters (StageCounters): Counters of the stage putting the item.
+        stopped (callable): Returns True when the pipeline was aborted and the item can be dropped.
+
+    Returns:
+        bool: True if the item was put, False if the pipeline was aborted meanwhile.
+    """
+    start = time.monotonic()
+    try:
+        while True:
+            try:
+                target.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if stopped():
+                    return False
+    finally:
+        counters.waited(time.monotonic() - start)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import math
+from .hierarchy import TerytIndex, unit_prefix
+
+# Endpoints used to fetch data
+BY_VARIABLE = "by-variable"  # one variable for every unit below a parent unit
+BY_UNIT = "by-unit"  # many variables for one unit
+
+PAGE_SIZE = 100  # records per page of the API
+MAX_VARIABLES_PER_REQUEST = 50  # var-id parameters accepted by one by-unit request
+
+
+class ParentCover(object):
+    """
+    Replaces groups of selected units by a common parent from the TERYT hierarchy
+    whenever one by-variable query on the parent needs fewer pages than the queries
+    on the units themselves. The parent query returns also units that were not selected,
+    they are dropped when the results are merged into the layer.
+    Parents and the numbers of the finest units come from the TerytIndex.
+    """
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self.index = TerytIndex.instance()
+
+    def pages(self, unit):
+        """
+        Number of pages returned by a by-variable query with the unit as unit-parent-id.
+        """
+        return max(1, math.ceil(self.index.leaf_count(unit) / self.page_size))
+
+    def cover(self, units):
+        """
+        Builds a minimal set of unit-parent ids covering the given units.
+
+        Args:
+            units (list): Unit codes to cover.
+
+        Returns:
+            list: Unit codes to query, in the order of the first unit each of them covers.
+        """
+        cover = list(dict.fromkeys(units))
+        changed = True
+        while changed:
+            changed = False
+            siblings = {}
+            for unit in cover:
+                parent = self.index.parent(unit)
+                if parent is not None:
+                    siblings.setdefault(parent, []).append(unit)
+
+            for parent, children in siblings.items():
+                if len(children) < 2 or self.pages(parent) >= sum(self.pages(child) for child in children):
+                    continue
+                position = cover.index(children[0])
+                cover = [unit for unit in cover if unit not in children]
+                cover.insert(position, parent)
+                changed = True
+                break
+        return cover
+
+
+class RequestPlanner(object):
+    """
+    Chooses how the data for the selected units and variables is requested. For every selected
+    unit it compares the by-variable endpoint (one request per variable and page of units) with
+    the by-unit endpoint (one request per unit and group of variables) and keeps the cheaper one.
+    Units left to the by-variable endpoint are grouped under common parents with ParentCover.
+    """
+    def __init__(self, units, variables, leaf_codes, page_size=PAGE_SIZE, max_variables=MAX_VARIABLES_PER_REQUEST, use_parent_cover=True):
+        """
+        Args:
+            units (list): Unit codes selected by the user.
+            variables (list): Variable IDs to fetch.
+            leaf_codes (list): Codes of the finest units the selection expands to.
+            page_size (int): Records per page of the API.
+            max_variables (int): Variables that can be asked for in one by-unit request.
+            use_parent_cover (bool): Whether selected units are grouped under common parents.
+        """
+        self.units = units
+        self.variables = variables
+        self.leaf_codes = leaf_codes
+        self.page_size = page_size
+        self.max_variables = max_variables
+        self.use_parent_cover = use_parent_cover
+        self.saved_requests = 0  # requests avoided by the parent cover, set by plan()
+
+    def leaves_of(self, unit):
+        """
+        Returns the finest units below the given unit.
+        """
+        prefix = unit_prefix(unit)
+        return [code for code in self.leaf_codes if code.startswith(prefix)]
+
+    def variable_groups(self):
+        """
+        Splits the variables into groups that fit into one by-unit request.
+        """
+        return [
+            tuple(self.variables[i:i + self.max_variables])
+            for i in range(0, len(self.variables), self.max_variables)
+        ]
+
+    def by_variable_cost(self, unit):
+        """
+        Estimated number of requests to fetch all variables for the unit with the by-variable endpoint.
+        """
+        pages = max(1, math.ceil(len(self.leaves_of(unit)) / self.page_size))
+        return len(self.variables) * pages
+
+    def by_unit_cost(self, unit):
+        """
+        Number of requests to fetch all variables for the unit with the by-unit endpoint.
+        """
+        return len(self.leaves_of(unit)) * len(self.variable_groups())
+
+    def plan(self):
+        """
+        Builds the list of requests.
+
+        Returns:
+            list: Tuples (endpoint, unit, variables). For BY_VARIABLE the unit is used as
+            unit-parent-id and variables holds one variable, for BY_UNIT the unit is a single
+            finest unit and variables holds the group of variables requested at once.
+        """
+        requests = []
+        by_variable_units = []
+        for unit in self.units:
+            leaves = self.leaves_of(unit)
+            if leaves and self.by_unit_cost(unit) < self.by_variable_cost(unit):
+                for group in self.variable_groups():
+                    for leaf in leaves:
+                        requests.append((BY_UNIT, leaf, group))
+            else:
+                by_variable_units.append(unit)
+
+        if self.use_parent_cover and by_variable_units:
+            parent_cover = ParentCover(self.page_size)
+            cover = parent_cover.cover(by_variable_units)
+            self.saved_requests = len(self.variables) * (
+                sum(parent_cover.pages(unit) for unit in by_variable_units) -
+                sum(parent_cover.pages(unit) for unit in cover)
+            )
+            by_variable_units = cover
+
+        # by-variable requests keep the original (variable, unit) order
+        for variable in self.variables:
+            for unit in by_variable_units:
+                requests.append((BY_VARIABLE, unit, (variable,)))
+        return requests
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import threading
+import time
+
+# BDL quotas for a registered client id: (window length in seconds, requests allowed)
+QUOTAS = (
+    (1, 10),                # per second
+    (15 * 60, 500),         # per 15 minutes
+    (12 * 60 * 60, 5000),   # per 12 hours
+    (7 * 24 * 60 * 60, 50000),  # per 7 days
+)
+
+# Period names used by the API in the X-Rate-Limit-Limit header
+PERIODS = {
+    "1s": 1,
+    "15m": 15 * 60,
+    "12h": 12 * 60 * 60,
+    "7d": 7 * 24 * 60 * 60,
+}
+
+SLEEP_STEP = 0.25  # seconds between the checks of an abort while waiting
+
+
+def sleep(delay, stopped=None):
+    """
+    Waits the given time, returning early when the caller stops.
+
+    Args:
+        delay (float): Seconds to wait.
+        stopped (callable): Returns True when the wait should end, may be None.
+
+    Returns:
+        bool: False if the wait ended because the caller stopped.
+    """
+    if stopped is None:
+        time.sleep(delay)
+        return True
+    deadline = time.monotonic() + delay
+    while not stopped():
+        left = deadline - time.monotonic()
+        if left <= 0:
+            return True
+        time.sleep(min(left, SLEEP_STEP))
+    return False
+
+
+class _Bucket(object):
+    """
+    Token bucket for one quota window of one client id.
+    """
+    def __init__(self, period, limit):
+        self.period = period
+        self.limit = limit
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        rate = self.limit / self.period
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until one request fits into the window."""
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) * self.period / self.limit
+
+
+class RateLimiter(object):
+    """
+    Process-wide limiter shared by every BDL caller. Keeps a token bucket for each quota
+    window of each client id and corrects them with the rate limit headers returned by the API.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the limiter shared by the whole QGIS session.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, quotas=QUOTAS):
+        self.quotas = quotas
+        self.buckets = {}  # {token: {period: _Bucket}}
+        self.blocked_until = {}  # {token: monotonic time}, set from Retry-After
+        self.lock = threading.Lock()
+
+    def _buckets(self, token):
+        if token not in self.buckets:
+            self.buckets[token] = {period: _Bucket(period, limit) for period, limit in self.quotas}
+        return self.buckets[token]
+
+    def wait_time(self, token):
+        """
+        Returns how many seconds a request with the given token has to wait.
+
+        Args:
+            token (str): The client id.
+
+        Returns:
+            float: Seconds to wait, 0 if the request can go out now.
+        """
+        with self.lock:
+            return self._wait_time(token, time.monotonic())
+
+    def _wait_time(self, token, now):
+        wait = max(0.0, self.blocked_until.get(token, 0) - now)
+        for bucket in self._buckets(token).values():
+            bucket.refill(now)
+            wait = max(wait, bucket.wait_time())
+        return wait
+
+    def acquire(self, token, stopped=None):
+        """
+        Blocks until a request with the given token is allowed by every quota window
+        and takes one request from each of them.
+
+        Args:
+            token (str): The client id.
+            stopped (callable): Returns True when the caller gives up waiting, may be None.
+
+        Returns:
+            bool: True if the request was allowed, False if the caller stopped first.
+        """
+        while True:
+            with self.lock:
+                wait = self._wait_time(token, time.monotonic())
+                if wait == 0:
+                    for bucket in self._buckets(token).values():
+                        bucket.tokens -= 1
+                    return True
+            if not sleep(wait, stopped):
+                return False
+
+    def update(self, token, response):
+        """
+        Corrects the state of the token with the headers of an API response.
+        The API reports the window in X-Rate-Limit-Limit (e.g. "15m") and the requests
+        left in it in X-Rate-Limit-Remaining. A Retry-After header blocks the token.
+
+        Args:
+            token (str): The client id used for the request.
+            response (requests.Response): The API response.
+        """
+        headers = response.headers
+        with self.lock:
+            now = time.monotonic()
+            period = PERIODS.get(headers.get("X-Rate-Limit-Limit", "").strip())
+            remaining = headers.get("X-Rate-Limit-Remaining")
+            if period is not None and remaining is not None:
+                bucket = self._buckets(token).get(period)
+                try:
+                    remaining = float(remaining)
+                except ValueError:
+                    remaining = None
+                if bucket is not None and remaining is not None:
+                    bucket.refill(now)
+                    bucket.tokens = min(bucket.tokens, remaining)
+
+            retry_after = headers.get("Retry-After")
+            if retry_after is not None:
+                try:
+                    self.blocked_until[token] = now + float(retry_after)
+                except ValueError:
+                    pass
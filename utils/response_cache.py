@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import json
+import threading
+import time
+import zlib
+from ..config import CACHE_PATH, CACHE_TTL, CACHE_MAX_SIZE
+from .database import reader, writer
+
+
+class CachedResponse(object):
+    """
+    A response read from the cache.
+
+    Attributes:
+        data (dict): The decoded JSON response.
+        fresh (bool): True if the response is younger than the TTL and can be used without asking the API.
+        etag (str): ETag sent by the API with the response, if any.
+        last_modified (str): Last-Modified sent by the API with the response, if any.
+    """
+    def __init__(self, data, fresh, etag, last_modified):
+        self.data = data
+        self.fresh = fresh
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def validators(self):
+        """
+        Returns the headers for a conditional request revalidating this response.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+    """
+    Persistent cache of data/by-variable responses stored in a separate SQLite file.
+    Lookups go through the read-only connection of the calling thread, changes through
+    the writer connection of the file.
+    Responses are kept compressed and keyed by the request: endpoint, variables, year filter,
+    unit, unit-level, page and language. The least recently used responses are evicted when the cache grows
+    over its size limit. Hits do not write, their access times are kept in memory and
+    written with the next change of the cache or by flush().
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the cache shared by the whole QGIS session.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_size=CACHE_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.accessed = {}  # {key: access time} of hits not written yet
+
+        with reader(path) as conn:
+            self.size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses;").fetchone()[0]
+
+    @staticmethod
+    def _key(endpoint, variables, years, unit, unit_level, page, language):
+        return (endpoint, ",".join(map(str, variables)), ",".join(map(str, years)),
+                str(unit), int(unit_level), int(page), language)
+
+    def get(self, endpoint, variables, years, unit, unit_level, page, language):
+        """
+        Reads a response from the cache.
+
+        Args:
+            endpoint (str): The data endpoint, by-variable or by-unit.
+            variables (list): IDs of the requested variables.
+            years (list): Years of the filter, empty for every year.
+            unit (str): unit-parent-id of a by-variable request, the unit of a by-unit one.
+            unit_level (int): The requested unit level.
+            page (int): The page number.
+            language (str): The language of the response.
+
+        Returns:
+            CachedResponse: The cached response or None if it is not in the cache.
+        """
+        key = self._key(endpoint, variables, years, unit, unit_level, page, language)
+        with reader(self.path) as conn:
+            row = conn.execute("""
+                SELECT body, etag, last_modified, fetched_at
+                FROM responses
+                WHERE endpoint = ? AND variables = ? AND years = ? AND unit = ? AND unit_level = ? AND page = ? AND language = ?
+            """, key).fetchone()
+        if row is None:
+            return None
+        now = int(time.time())
+        with self.lock:
+            self.accessed[key] = now
+        body, etag, last_modified, fetched_at = row
+        data = json.loads(zlib.decompress(body).decode("utf-8"))
+        return CachedResponse(data, now - fetched_at < self.ttl, etag, last_modified)
+
+    def put(self, endpoint, variables, years, unit, unit_level, page, language, response):
+        """
+        Stores a successful API response in the cache, keyed as in get().
+
+        Args:
+            response (requests.Response): The API response with status 200.
+        """
+        key = self._key(endpoint, variables, years, unit, unit_level, page, language)
+        body = zlib.compress(response.content)
+        now = int(time.time())
+        with writer(self.path) as conn:
+            self._write_accessed(conn)
+            old = conn.execute("""
+                SELECT size FROM responses
+                WHERE endpoint = ? AND variables = ? AND years = ? AND unit = ? AND unit_level = ? AND page = ? AND language = ?
+            """, key).fetchone()
+            conn.execute("""
+                INSERT OR REPLACE INTO responses
+                    (endpoint, variables, years, unit, unit_level, page, language,
+                     body, etag, last_modified, fetched_at, accessed_at, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, key + (
+                body,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                now,
+                now,
+                len(body)
+            ))
+            self.size += len(body) - (old[0] if old else 0)
+            self._evict(conn)
+
+    def revalidated(self, endpoint, variables, years, unit, unit_level, page, language):
+        """
+        Marks a cached response as fresh again after the API answered 304 Not Modified.
+        The response is keyed as in get().
+        """
+        key = self._key(endpoint, variables, years, unit, unit_level, page, language)
+        with writer(self.path) as conn:
+            conn.execute("""
+                UPDATE responses SET fetched_at = ?
+                WHERE endpoint = ? AND variables = ? AND years = ? AND unit = ? AND unit_level = ? AND page = ? AND language = ?
+            """, (int(time.time()),) + key)
+
+    def flush(self):
+        """
+        Writes the access times of the hits since the last change in one transaction.
+        """
+        with self.lock:
+            if not self.accessed:
+                return
+        with writer(self.path) as conn:
+            self._write_accessed(conn)
+
+    def _write_accessed(self, conn):
+        # the eviction order needs the access times of recent hits
+        with self.lock:
+            rows = [(accessed_at,) + key for key, accessed_at in self.accessed.items()]
+            self.accessed.clear()
+        conn.executemany("""
+            UPDATE responses SET accessed_at = ?
+            WHERE endpoint = ? AND variables = ? AND years = ? AND unit = ? AND unit_level = ? AND page = ? AND language = ?
+        """, rows)
+
+    def _evict(self, conn):
+        # drops the least recently used responses until the cache fits its size limit
+        while self.size > self.max_size:
+            rows = conn.execute("""
+                SELECT rowid, size FROM responses ORDER BY accessed_at LIMIT 100
+            """).fetchall()
+            if not rows:
+                self.size = 0
+                return
+            for rowid, size in rows:
+                if self.size <= self.max_size:
+                    break
+                conn.execute("DELETE FROM responses WHERE rowid = ?", (rowid,))
+                self.size -= size
+
+    def clear(self):
+        """
+        Removes every response from the cache.
+        """
+        with writer(self.path) as conn:
+            conn.execute("DELETE FROM responses;")
+            self.size = 0
+        with self.lock:
+            self.accessed.clear()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Kinds of failures counted by the policy
+RATE_LIMITED = "rate_limited"  # 429 Too Many Requests
+SERVER_ERROR = "server_error"  # 5xx
+NETWORK_ERROR = "network_error"  # connection problems and timeouts
+
+
+class RetryPolicy(object):
+    """
+    Retry policy shared by every BDL caller, used by BDLClient. Failed requests are retried
+    with exponential backoff and jitter. A 429 answer waits as long as the Retry-After header
+    says, up to max_delay, a longer wait is left to the caller which can switch to another
+    client id. 5xx answers and network errors back off, other answers are returned at once.
+    The policy counts the retries of each kind of failure.
+    """
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, jitter=0.5, max_rate_limited_attempts=3):
+        """
+        Args:
+            max_attempts (int): Attempts of a request failing with 5xx or a network error.
+            base_delay (float): Delay before the first retry in seconds, doubled for every next one.
+            max_delay (float): Upper bound of the backoff delay and of the Retry-After wait in seconds.
+            jitter (float): Fraction of the delay randomised to spread retries of parallel requests.
+            max_rate_limited_attempts (int): Attempts of a request answered with 429. After them
+                the caller should switch to another client id.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_rate_limited_attempts = max_rate_limited_attempts
+
+        self.lock = threading.Lock()
+        self.counters = {RATE_LIMITED: 0, SERVER_ERROR: 0, NETWORK_ERROR: 0}
+
+    def backoff(self, attempt):
+        """
+        Returns the delay before the retry following the given attempt.
+
+        Args:
+            attempt (int): Number of the failed attempt, starting at 0.
+
+        Returns:
+            float: Delay in seconds.
+        """
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay * (1 - self.jitter + random.random() * self.jitter)
+
+    def retry_after(self, response):
+        """
+        Reads the Retry-After header, given either in seconds or as an HTTP date.
+
+        Returns:
+            float: Delay in seconds or None if the header is missing or invalid.
+        """
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def retry_delay(self, attempt, response, error):
+        """
+        Decides whether a request is sent again.
+
+        Args:
+            attempt (int): Number of the attempt that just finished, starting at 0.
+            response (requests.Response): The response or None after a network error.
+            error (Exception): The network error or None.
+
+        Returns:
+            float: Seconds to wait before the next attempt or None to stop.
+        """
+        if error is not None:
+            kind = NETWORK_ERROR
+        elif response.status_code == 429:
+            kind = RATE_LIMITED
+        elif response.status_code >= 500:
+            kind = SERVER_ERROR
+        else:
+            return None
+
+        if kind == RATE_LIMITED:
+            if attempt + 1 >= self.max_rate_limited_attempts:
+                return None
+            delay = self.retry_after(response)
+            if delay is None:
+                delay = self.backoff(attempt)
+            elif delay > self.max_delay:
+                return None
+        else:
+            if attempt + 1 >= self.max_attempts:
+                return None
+            delay = self.backoff(attempt)
+
+        with self.lock:
+            self.counters[kind] += 1
+        return delay
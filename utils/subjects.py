@@ -11,44 +11,16 @@
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
 import requests
-import sqlite3
 import time
 from .tokens import Tokens
-from ..config import DB_PATH
+from .client import BDLClient
+from .database import reader, writer
+from .migrations import create_subjects
 
 # Config
 API_BASE_URL_SUBJECTS = "https://bdl.stat.gov.pl/api/v1/subjects"
-REQUESTS_PER_SECONDS_LIMIT = 30 # Max 30 requests per minute
 
 class Subjects(object):
-    def __init__(self):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS subjects (
-                    subject_code TEXT NOT NULL,
-                    parent_id TEXT,
-                    name TEXT NOT NULL,
-                    language TEXT NOT NULL,
-                    has_variables BOOLEAN,
-                    children_fetched BOOLEAN DEFAULT 0 -- status for children: 0 - not fetched, 1 - fetched
-                );
-            ''')
-            # Indexes
-            #the short code is mostly used for searching
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS subjects_subject_code_idx ON subjects (subject_code);
-            ''')
-            # we will search also by parent_id
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS subjects_parent_id_idx ON subjects (parent_id);
-            ''')
-            # unique are subject_code with language
-            cursor.execute('''
-                CREATE UNIQUE INDEX IF NOT EXISTS subjects_subject_code_language_idx ON subjects (subject_code, language);
-            ''')
-            conn.commit()
-    
     def add_subject(self, cursor, subject_code, parent_id, name, lang, has_variables):
         cursor.execute('''
             INSERT INTO subjects (subject_code, parent_id, name, language, has_variables, children_fetched)
@@ -70,8 +42,11 @@ class Subjects(object):
         if parent is None:
             data.pop("parent-id")
         # Send request
-        headers = {"X-ClientId": token}
-        response = requests.get(API_BASE_URL_SUBJECTS, headers=headers, params=data)
+        try:
+            response = BDLClient.instance().get(API_BASE_URL_SUBJECTS, params=data, token=token)
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR {e}. TOKEN {token}")
+            return None
         if response.status_code == 200:
             return response.json()
         else:
@@ -95,31 +70,33 @@ class Subjects(object):
             lang (str): The language code to fetch subjects in.
 
         """
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            page = 0
-            while True:
-                data = self.fetch_subjects_page(parent, page, lang)
-                
-                if not data:
-                    # token failed
-                    time.sleep(5)
-                    continue            
-                for item in data["results"]:
-                    if 6 in item["levels"]:
-                        self.add_subject(cursor, item["id"], parent, item["name"], lang, item["hasVariables"])
-                if "next" not in data["links"]:
-                    break            
-                page += 1
+        # all pages are fetched before writing, the writer is not held during requests
+        items = []
+        page = 0
+        failures = 0  # consecutive failed pages, the wait grows with them
+        while True:
+            data = self.fetch_subjects_page(parent, page, lang)
             
-            self.mark_parent_fetched(cursor, parent, lang)
+            if not data:
+                # token failed
+                time.sleep(BDLClient.instance().retry_policy.backoff(failures))
+                failures += 1
+                continue
+            failures = 0
+            items.extend(item for item in data["results"] if 6 in item["levels"])
+            if "next" not in data["links"]:
+                break            
+            page += 1
 
-            conn.commit()
-            time.sleep(1/REQUESTS_PER_SECONDS_LIMIT)  # Rate limiting between requests
+        with writer() as conn:
+            cursor = conn.cursor()
+            for item in items:
+                self.add_subject(cursor, item["id"], parent, item["name"], lang, item["hasVariables"])
+            self.mark_parent_fetched(cursor, parent, lang)
 
     def get_uncompleted_parent(self,lang):
         print("Checking for uncompleted parent")
-        with sqlite3.connect(DB_PATH) as conn:
+        with reader() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                         SELECT subject_code 
@@ -142,13 +119,13 @@ class Subjects(object):
             # gettting next parent
 
     def recreate_subjects_table(self):
-        with sqlite3.connect(DB_PATH) as conn:
+        with writer() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                            DROP TABLE IF EXISTS subjects;
                             ''')
-            conn.commit()
-        self.__init__()
+        with writer() as conn:
+            create_subjects(conn)
         self.fetch_clild_subjects(None, "pl")
         self.uncompleated_subjects("pl")
         self.fetch_clild_subjects(None, "en")
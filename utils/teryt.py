@@ -11,57 +11,28 @@
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
 import requests
-import sqlite3
 import time
 
 from .geometry import Geometry
 from .tokens import Tokens
-from ..config import DB_PATH 
+from .client import BDLClient
+from .hierarchy import TerytIndex
+from .migrations import create_teryt_codes
+from .database import writer
 from .translations import _,gus_language
 
 # Configuration
 API_BASE_URL = "https://bdl.stat.gov.pl/api/v1/units"
-REQUESTS_PER_SECOND_LIMIT = 30  # maksymalnie 10 zapytania na sekundę
 
 
 class Teryt(object):
-    def __init__(self):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS teryt_codes (
-                    short_code TEXT NOT NULL,
-                    full_code TEXT NOT NULL,
-                    parent_code TEXT,
-                    name TEXT NOT NULL,
-                    kind TEXT,
-                    level INTEGER NOT NULL,
-                    language TEXT NOT NULL
-                );
-            ''')
-            # Indexes
-            #the short code is mostly used for searching
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS teryt_codes_short_code_idx ON teryt_codes (short_code);
-            ''')
-            # we will search also by parent_code that is search for children
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS teryt_codes_parent_code_idx ON teryt_codes (parent_code);
-            ''')    
-            # unique are fullcode with language
-            cursor.execute('''
-                CREATE UNIQUE INDEX IF NOT EXISTS teryt_codes_full_code_language_idx ON teryt_codes (full_code, language);
-            ''')
-            conn.commit()
-
     def _add_teryt_code(self, short_code, full_code, parent_code, name, kind, level, lang):
-        with sqlite3.connect(DB_PATH) as conn:
+        with writer() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO teryt_codes (short_code, full_code, parent_code, name, kind, level, language)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (short_code, full_code, parent_code, name, kind, level, lang))
-            conn.commit()
 
     def _fetch_teryt_page(self,page,lang):
         
@@ -72,8 +43,11 @@ class Teryt(object):
             "lang": lang,
             "page-size": 100
         }
-        headers = {"X-ClientId": token}
-        response = requests.get(API_BASE_URL, headers=headers, params=params)
+        try:
+            response = BDLClient.instance().get(API_BASE_URL, params=params, token=token)
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR {e}. TOKEN {token}")
+            return None
         if response.status_code == 200:
             return response.json()
         else:
@@ -82,12 +56,14 @@ class Teryt(object):
 
     def _fetch_and_save_teryt_codes(self,lang):
         page = 0
+        failures = 0  # consecutive failed pages, the wait grows with them
         while True:
             data = self._fetch_teryt_page(page,lang)
             if not data:
-                
-                time.sleep(5)
+                time.sleep(BDLClient.instance().retry_policy.backoff(failures))
+                failures += 1
                 continue
+            failures = 0
             for code in data["results"]:
                 full_code = code.get("id")
                 short_code = full_code[2:4]+full_code[7:11]
@@ -101,7 +77,6 @@ class Teryt(object):
             if "next" not in data["links"]:
                 break
             page += 1
-            time.sleep(1 / REQUESTS_PER_SECOND_LIMIT)
     
     def code_to_name(self,shorter_code, kind, lang):
         """
@@ -114,11 +89,7 @@ class Teryt(object):
         Returns:
             str: The human-readable name of the code. If the code is not found, returns None.
         """
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM teryt_codes WHERE short_code = ? AND kind = ? AND language = ?", (shorter_code, kind, lang))
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return TerytIndex.instance().name(shorter_code, kind, lang)
     
     def get_type_name(self, level, kind):
         """
@@ -147,16 +118,17 @@ class Teryt(object):
         Recreates the TERYT table.
         Do not use this method unless you know what you are doing.
         """
-        with sqlite3.connect(DB_PATH) as conn:
+        with writer() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 DROP TABLE IF EXISTS teryt_codes;
             ''')
-            conn.commit()
-        self.__init__()
+        with writer() as conn:
+            create_teryt_codes(conn)
+        TerytIndex.reset()
         self.fetch_and_save_teryt_codes("pl")
         self.fetch_and_save_teryt_codes("en")
-        with sqlite3.connect(DB_PATH) as conn:
+        with writer() as conn:
             cursor = conn.cursor()
             # as a final step we have to remove the old capital city code
             # and every kind 2 that we have kind 3 for 
@@ -171,4 +143,4 @@ class Teryt(object):
                             t2.kind = '3'
                            )
                     )''');      
-            conn.commit()
+        TerytIndex.reset()
@@ -10,45 +10,147 @@
 ###############################################################################
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
+import atexit
+import random
 import requests
+import threading
 import time
 import uuid
-import sqlite3
-from ..config import DB_PATH
+from .database import reader, writer
+from .rate_limiter import RateLimiter
 
 url =  "https://bdl.stat.gov.pl/api/v1/client?lang=pl"
 
-class Tokens(object):
+TOKEN_COOLDOWN = 900  # seconds a failed token is not used, 15 minutes
+FLUSH_EVERY = 20  # number of changed tokens that triggers a write to the database
+FLUSH_INTERVAL = 60  # seconds after which changed tokens are written anyway
+LATENCY_SMOOTHING = 0.2  # weight of the newest sample in the moving average of latency
+
+
+class TokenPool(object):
+    """
+    Process-wide pool of client ids. The tokens table is read once and the state of every
+    token (cooldown, remaining quota, recent latency) is kept in memory. Failures are written
+    back to the database in batches.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        Returns the pool shared by the whole QGIS session.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                atexit.register(cls._instance.flush)
+            return cls._instance
+
     def __init__(self):
-        with sqlite3.connect(DB_PATH) as conn:
+        self.lock = threading.Lock()
+        self.limiter = RateLimiter.instance()
+        self.last_failed = {}  # {token: unix time of the last failure}
+        self.remaining = {}  # {token: requests left in the window reported by the API}
+        self.latency = {}  # {token: moving average of response time in seconds}
+        self.dirty = set()  # tokens whose failure time is not written to the database yet
+        self.last_flush = time.monotonic()
+
+        with reader() as conn:
             cursor = conn.cursor()
-            cursor.execute("""CREATE TABLE IF NOT EXISTS tokens (
-                                token TEXT PRIMARY KEY,
-                                last_failed_time INTEGER
-                         );""")
-            conn.commit()
+            cursor.execute("SELECT token, last_failed_time FROM tokens;")
+            for token, last_failed_time in cursor.fetchall():
+                self.last_failed[token] = last_failed_time or 0
+
+    def add(self, token):
+        """
+        Adds a new token to the pool.
+
+        Args:
+            token (str): The client id.
+        """
+        with self.lock:
+            self.last_failed.setdefault(token, 0)
+
+    def get_token(self):
+        """
+        Returns the healthiest token: one that is not cooling down after a failure and has
+        the shortest wait in the rate limiter, the most quota left and the lowest latency.
+
+        Returns:
+            str: The client id or None if every token is cooling down.
+        """
+        now = time.time()
+        with self.lock:
+            candidates = [token for token, failed in self.last_failed.items() if failed < now - TOKEN_COOLDOWN]
+            if not candidates:
+                return None
+            return min(candidates, key=lambda token: (
+                round(self.limiter.wait_time(token), 1),
+                -self.remaining.get(token, float("inf")),
+                round(self.latency.get(token, 0.0), 1),
+                random.random()  # spread ties over the pool
+            ))
+
+    def report(self, token, response, latency):
+        """
+        Records the outcome of a successful request.
+
+        Args:
+            token (str): The client id used for the request.
+            response (requests.Response): The API response.
+            latency (float): Time the request took in seconds.
+        """
+        with self.lock:
+            previous = self.latency.get(token, latency)
+            self.latency[token] = previous + LATENCY_SMOOTHING * (latency - previous)
+            remaining = response.headers.get("X-Rate-Limit-Remaining")
+            if remaining is not None and remaining.isdigit():
+                self.remaining[token] = int(remaining)
+
+    def mark_token_failed(self, token):
+        """
+        Puts the token into cooldown. The failure is written to the database with the next batch.
+
+        Args:
+            token (str): The client id.
+        """
+        with self.lock:
+            self.last_failed[token] = int(time.time())
+            self.dirty.add(token)
+            flush = len(self.dirty) >= FLUSH_EVERY or time.monotonic() - self.last_flush > FLUSH_INTERVAL
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the failure times of changed tokens to the database in one transaction.
+        """
+        with self.lock:
+            rows = [(self.last_failed[token], token) for token in self.dirty]
+            self.dirty.clear()
+            self.last_flush = time.monotonic()
+        if not rows:
+            return
+        with writer() as conn:
+            conn.executemany("UPDATE tokens SET last_failed_time = ? WHERE token = ?;", rows)
+
+
+class Tokens(object):
+    def __init__(self):
+        self.pool = TokenPool.instance()
     
     def _add_token(self, token):
-        with sqlite3.connect(DB_PATH) as conn:
+        with writer() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT INTO tokens (token, last_failed_time) VALUES (?, ?);", (token, 0))
-            conn.commit()
+        self.pool.add(token)
 
     def get_random_token(self):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""SELECT token FROM tokens
-                                WHERE last_failed_time < ?
-                            ORDER BY RANDOM() LIMIT 1;""",
-                            (int(time.time())-900,)) ## 15 minutes
-            token = cursor.fetchone()
-            return token[0] if token else None
+        return self.pool.get_token()
     
     def mark_token_failed(self, token):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE tokens SET last_failed_time = ? WHERE token = ?;", (int(time.time()), token))
-            conn.commit()
+        self.pool.mark_token_failed(token)
     
     def _create_new_token(self):
         mail_uuid = str(uuid.uuid4())
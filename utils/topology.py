@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (C) 2024 Wawrzyniec Zipser, Maciej Kamiński (maciej.kaminski@pwr.edu.pl)
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at https://mozilla.org/MPL/2.0/.
+#
+###############################################################################
+__author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
+
+import json
+import struct
+import zlib
+import numpy as np
+
+QUANTIZATION_STEP = 0.1  # metres (EPSG:2180) of the integer grid the coordinates are snapped to
+
+_WKB_LITTLE_ENDIAN = 1
+_WKB_POLYGON = 3
+_WKB_MULTIPOLYGON = 6
+
+# Arc references of the units whose codes are passed as a JSON array of [code, type]
+_UNITS_QUERY = """
+    SELECT t.code, t.type, t.arcs
+    FROM json_each(?) AS c
+    JOIN topology_units AS t ON t.code = json_extract(c.value, '$[0]') AND t.type = json_extract(c.value, '$[1]')
+"""
+
+
+def _wkb_multipolygon(polygons):
+    # polygons are lists of closed rings, each an (n, 2) array of coordinates
+    parts = [struct.pack('<BII', _WKB_LITTLE_ENDIAN, _WKB_MULTIPOLYGON, len(polygons))]
+    for rings in polygons:
+        parts.append(struct.pack('<BII', _WKB_LITTLE_ENDIAN, _WKB_POLYGON, len(rings)))
+        for ring in rings:
+            parts.append(struct.pack('<I', len(ring)))
+            parts.append(np.ascontiguousarray(ring, dtype='<f8').tobytes())
+    return b''.join(parts)
+
+
+def _points(blob):
+    # points of an arc on the integer grid as an (n, 2) array
+    return np.frombuffer(zlib.decompress(blob), dtype='<i4').reshape(-1, 2).cumsum(axis=0)
+
+
+def _simplify(points, tolerance):
+    # Douglas-Peucker keeping the end points of the arc, the tolerance is in grid units
+    if len(points) < 3:
+        return points
+    coords = points.astype(float)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = coords[end] - coords[start]
+        offsets = coords[start + 1:end] - coords[start]
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            # a closed arc, the distance is measured from its start
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return points[keep]
+
+
+class Topology(object):
+    """
+    Geometries of the units stored as shared arcs, the way TopoJSON does. Coordinates are
+    snapped to an integer grid and rings are cut where neighbouring units meet, so a border
+    of two communes is stored once and referenced by both of them. An arc is kept in
+    topology_arcs as zlib compressed int32 deltas of its points. A unit in topology_units
+    is a JSON list of polygons, each a list of rings, each a list of arc references,
+    where ~i means the arc i traversed backwards.
+    Exterior rings are counter-clockwise and holes clockwise, so an arc shared by two
+    adjacent units is traversed in opposite directions.
+    """
+
+    def _polygons(self, geometry):
+        # polygons of a shapely geometry with exteriors counter-clockwise
+        from shapely.geometry import Polygon
+        from shapely.geometry.polygon import orient
+        if isinstance(geometry, Polygon):
+            parts = [geometry]
+        else:
+            parts = [part for part in getattr(geometry, 'geoms', []) if isinstance(part, Polygon)]
+        return [orient(part, 1.0) for part in parts if not part.is_empty]
+
+    def _quantize(self, coords, translate):
+        # ring snapped to the grid, without repeated points and kept open
+        ring = []
+        for x, y, *_z in coords:
+            point = (
+                int(round((x - translate[0]) / QUANTIZATION_STEP)),
+                int(round((y - translate[1]) / QUANTIZATION_STEP))
+            )
+            if not ring or ring[-1] != point:
+                ring.append(point)
+        if len(ring) > 1 and ring[0] == ring[-1]:
+            ring.pop()
+        return ring if len(ring) >= 3 else None
+
+    def build(self, conn):
+        """
+        Builds the arcs and the units from the geometries table, replacing the previous ones.
+
+        Args:
+            conn (sqlite3.Connection): Writer connection to the database.
+
+        Returns:
+            int: The number of arcs.
+        """
+        from shapely import wkb
+        rows = conn.execute("SELECT code, type, geometry FROM geometries WHERE geometry IS NOT NULL").fetchall()
+        shapes = [(code, kind, self._polygons(wkb.loads(bytes(geometry)))) for code, kind, geometry in rows]
+        bounds = [polygon.bounds for _code, _kind, polygons in shapes for polygon in polygons]
+        if not bounds:
+            return 0
+        translate = (min(bound[0] for bound in bounds), min(bound[1] for bound in bounds))
+
+        units = []  # [(code, kind, [[ring]])]
+        for code, kind, polygons in shapes:
+            unit_polygons = []
+            for polygon in polygons:
+                exterior = self._quantize(polygon.exterior.coords, translate)
+                if exterior is None:
+                    continue
+                holes = [self._quantize(interior.coords, translate) for interior in polygon.interiors]
+                unit_polygons.append([exterior] + [hole for hole in holes if hole is not None])
+            units.append((code, kind, unit_polygons))
+
+        # a point is a junction when the rings passing it do not all share its neighbours
+        neighbours = {}
+        junctions = set()
+        for _code, _kind, polygons in units:
+            for rings in polygons:
+                for ring in rings:
+                    count = len(ring)
+                    for i, point in enumerate(ring):
+                        previous, following = ring[i - 1], ring[(i + 1) % count]
+                        pair = (previous, following) if previous < following else (following, previous)
+                        if neighbours.setdefault(point, pair) != pair:
+                            junctions.add(point)
+        del neighbours
+
+        arcs = []
+        index = {}  # {points: arc id}
+
+        def arc_ref(points):
+            key = tuple(points)
+            if key in index:
+                return index[key]
+            if key[::-1] in index:
+                return ~index[key[::-1]]
+            index[key] = len(arcs)
+            arcs.append(key)
+            return index[key]
+
+        def ring_refs(ring):
+            cuts = [i for i, point in enumerate(ring) if point in junctions]
+            if not cuts:
+                # the whole ring is one closed arc, started at its lowest point so neighbours find it
+                start = ring.index(min(ring))
+                rotated = ring[start:] + ring[:start]
+                return [arc_ref(rotated + rotated[:1])]
+            rotated = ring[cuts[0]:] + ring[:cuts[0]] + [ring[cuts[0]]]
+            cuts = [cut - cuts[0] for cut in cuts] + [len(ring)]
+            return [arc_ref(rotated[start:end + 1]) for start, end in zip(cuts, cuts[1:])]
+
+        unit_rows = [
+            (code, kind, json.dumps([[ring_refs(ring) for ring in rings] for rings in polygons], separators=(',', ':')))
+            for code, kind, polygons in units
+        ]
+        arc_rows = [
+            (arc_id, zlib.compress(np.diff(np.array(points, dtype=np.int64), axis=0, prepend=[[0, 0]]).astype('<i4').tobytes()))
+            for arc_id, points in enumerate(arcs)
+        ]
+
+        conn.execute("DELETE FROM topology_arcs;")
+        conn.execute("DELETE FROM topology_units;")
+        conn.execute("DELETE FROM topology_transform;")
+        conn.executemany("INSERT INTO topology_arcs (id, points) VALUES (?, ?)", arc_rows)
+        conn.executemany("INSERT INTO topology_units (code, type, arcs) VALUES (?, ?, ?)", unit_rows)
+        conn.execute(
+            "INSERT INTO topology_transform (step, translate_x, translate_y) VALUES (?, ?, ?)",
+            (QUANTIZATION_STEP, translate[0], translate[1])
+        )
+        return len(arcs)
+
+    def _units(self, conn, codes):
+        cursor = conn.cursor()
+        cursor.execute(_UNITS_QUERY, (json.dumps(sorted(set(codes))),))
+        return {(code, kind): json.loads(arcs) for code, kind, arcs in cursor.fetchall()}
+
+    def _arcs(self, conn, arc_ids):
+        # points of the arcs on the integer grid, as (n, 2) arrays
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT a.id, a.points
+            FROM json_each(?) AS c
+            JOIN topology_arcs AS a ON a.id = c.value
+        """, (json.dumps(sorted(arc_ids)),))
+        return {arc_id: _points(points) for arc_id, points in cursor.fetchall()}
+
+    def _transform(self, conn):
+        # (step, translate_x, translate_y) from the grid to EPSG:2180
+        return conn.execute("SELECT step, translate_x, translate_y FROM topology_transform").fetchone()
+
+    def _to_wkb(self, polygons, transform):
+        step, translate_x, translate_y = transform
+        return _wkb_multipolygon([
+            [ring * step + (translate_x, translate_y) for ring in rings]
+            for rings in polygons
+        ])
+
+    def _ring(self, refs, arcs):
+        # consecutive arcs share their end points
+        parts = []
+        for ref in refs:
+            points = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+            parts.append(points if not parts else points[1:])
+        return np.concatenate(parts)
+
+    def geometries(self, conn, codes):
+        """
+        Assembles the geometries of units from their arcs.
+
+        Args:
+            conn (sqlite3.Connection): Connection to the database.
+            codes (list): Tuples (shorter_code, kind).
+
+        Returns:
+            dict: Mapping of (shorter_code, kind) to MultiPolygon WKB, codes not found are missing.
+        """
+        units = self._units(conn, codes)
+        if not units:
+            return {}
+        arcs = self._arcs(conn, {
+            ref if ref >= 0 else ~ref
+            for polygons in units.values() for rings in polygons for ring in rings for ref in ring
+        })
+        transform = self._transform(conn)
+        return {
+            key: self._to_wkb([[self._ring(ring, arcs) for ring in rings] for rings in polygons], transform)
+            for key, polygons in units.items()
+        }
+
+    def simplified(self, conn, tolerances):
+        """
+        Simplifies every arc once per level of detail and assembles the units from the simplified
+        arcs. A border of two units is one arc, so the neighbours keep identical borders at every
+        level and no slivers open between them. The end points of the arcs, where three or more
+        units meet, are kept. A unit too small for a level keeps its geometry of the finer level.
+
+        Args:
+            conn (sqlite3.Connection): Connection to the database.
+            tolerances (dict): Mapping of the level of detail to its tolerance in metres.
+
+        Yields:
+            tuple: The shorter code, kind, level and MultiPolygon WKB of each unit.
+        """
+        transform = self._transform(conn)
+        if transform is None:
+            return
+        units = {
+            (code, kind): json.loads(arcs)
+            for code, kind, arcs in conn.execute("SELECT code, type, arcs FROM topology_units").fetchall()
+        }
+        arcs = {arc_id: _points(points) for arc_id, points in conn.execute("SELECT id, points FROM topology_arcs").fetchall()}
+
+        finer = {}  # {(code, kind): polygons} of the previous level
+        for level, tolerance in sorted(tolerances.items()):
+            level_arcs = {arc_id: _simplify(points, tolerance / transform[0]) for arc_id, points in arcs.items()}
+            for key, polygons in units.items():
+                assembled = []
+                for rings in polygons:
+                    # a closed ring needs at least four points, collapsed holes are dropped
+                    ring_points = [self._ring(ring, level_arcs) for ring in rings]
+                    if len(ring_points[0]) >= 4:
+                        assembled.append([ring_points[0]] + [ring for ring in ring_points[1:] if len(ring) >= 4])
+                if not assembled:
+                    assembled = finer.get(key) or [[self._ring(ring, arcs) for ring in rings] for rings in polygons]
+                finer[key] = assembled
+                yield key[0], key[1], level, self._to_wkb(assembled, transform)
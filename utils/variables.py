@@ -11,48 +11,24 @@
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
 import requests
-import sqlite3
 import time
 from .tokens import Tokens
+from .client import BDLClient
 from .subjects import Subjects
-from ..config import DB_PATH
+from .response_cache import ResponseCache
+from .planner import BY_VARIABLE
+from .database import reader, writer
+from .migrations import create_variables
 
 # Konfiguracja bazy danych i API
 API_BASE_URL_VARIABLES = "https://bdl.stat.gov.pl/api/v1/Variables"
-REQUESTS_PER_SECOND_LIMIT = 30
+API_DATA_BY_VARIABLE_URL = "https://bdl.stat.gov.pl/api/v1/data/by-variable"
+API_YEARS_URL = "https://bdl.stat.gov.pl/api/v1/years"
 PAGE_SIZE = 100
+MAX_ATTEMPTS = 3  # tokens tried for a single metadata request
 
 
 class Variables(object):
-    def __init__(self):
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS variables (
-                    id INTEGER,
-                    subject_id TEXT,
-                    n1 TEXT,
-                    n2 TEXT,
-                    n3 TEXT,
-                    n4 TEXT,
-                    n5 TEXT,    
-                    language TEXT NOT NULL,
-                    level INTEGER,
-                    measure_unit_id INTEGER,
-                    measure_unit_name TEXT
-                );
-            ''')
-            # Indexes
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS variables_subject_id_idx ON variables (subject_id);
-            ''')
-            # unique are id with language
-            cursor.execute('''
-                CREATE UNIQUE INDEX IF NOT EXISTS variables_id_language_idx ON variables (id, language);
-            ''')
-
-            conn.commit()
-
     def add_variable(self, cursor, item,lang):
         cursor.execute('''
             INSERT OR REPLACE INTO variables (id, subject_id, n1, n2, n3, n4, n5, language, level, measure_unit_id, measure_unit_name)
@@ -72,7 +48,7 @@ class Variables(object):
         ))
 
     def get_pending_subject_with_variables(self,lang):
-        with sqlite3.connect(DB_PATH) as conn:
+        with reader() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                         SELECT subject_code
@@ -95,36 +71,114 @@ class Variables(object):
             "page": page,
             "subject-id": subject_code
         }
-        headers = {"X-ClientId": token}
-        response = requests.get(API_BASE_URL_VARIABLES, headers=headers, params=data)
+        try:
+            response = BDLClient.instance().get(API_BASE_URL_VARIABLES, params=data, token=token)
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR {e}. TOKEN {token}")
+            return None
         if response.status_code == 200:
             return response.json()
         else:
             print(f"ERROR {response.status_code}. TOKEN {token}")
             Tokens().mark_token_failed(token)
 
+    def _get(self, url, params):
+        """
+        Sends a request with a client id, trying another token when the request fails.
+
+        Returns:
+            requests.Response: The successful response or None.
+        """
+        tokens = Tokens()
+        for _attempt in range(MAX_ATTEMPTS):
+            token = tokens.get_random_token()
+            try:
+                response = BDLClient.instance().get(url, params=params, token=token)
+            except requests.exceptions.RequestException as e:
+                print(f"ERROR {e}. TOKEN {token}")
+                continue
+            if response.status_code == 200:
+                return response
+            print(f"ERROR {response.status_code}. TOKEN {token}")
+            tokens.mark_token_failed(token)
+        return None
+
+    def available_years(self, variable_id, lang):
+        """
+        Returns the years with data for the variable. The country level value of the variable
+        comes in one small response listing every year, it is kept in the response cache.
+        When it is empty, all years known to the API are returned.
+
+        Args:
+            variable_id (str): The ID of the variable.
+            lang (str): The language code of the request.
+
+        Returns:
+            list: Sorted years as strings.
+        """
+        cache = ResponseCache.instance()
+        cache_key = (BY_VARIABLE, [variable_id], [], "", 0, 0, lang)
+        cached = cache.get(*cache_key)
+        if cached is not None and cached.fresh:
+            data = cached.data
+        else:
+            response = self._get(f"{API_DATA_BY_VARIABLE_URL}/{variable_id}", {
+                "unit-level": 0,
+                "lang": lang,
+                "format": "json"
+            })
+            if response is None:
+                return self.all_years(lang)
+            cache.put(*cache_key, response)
+            data = response.json()
+
+        years = sorted({
+            str(value["year"])
+            for result in data.get("results", [])
+            for value in result.get("values", [])
+        })
+        return years if years else self.all_years(lang)
+
+    def all_years(self, lang):
+        """
+        Returns every year known to the API.
+
+        Args:
+            lang (str): The language code of the request.
+
+        Returns:
+            list: Sorted years as strings, empty when the API does not answer.
+        """
+        response = self._get(API_YEARS_URL, {"lang": lang, "format": "json", "page-size": PAGE_SIZE})
+        if response is None:
+            return []
+        return sorted(str(item["id"]) for item in response.json().get("results", []))
+
     def fetch_and_save_variables(self, subject_code, lang):
-        with sqlite3.connect(DB_PATH) as conn:
+        # all pages are fetched before writing, the writer is not held during requests
+        items = []
+        page = 0
+        failures = 0  # consecutive failed pages, the wait grows with them
+        while True:
+            data = self.fetch_variables_page(subject_code, page, lang)
+            if not data:
+                time.sleep(BDLClient.instance().retry_policy.backoff(failures))
+                failures += 1
+                continue
+            failures = 0
+            
+            items.extend(item for item in data["results"] if int(item["level"]) == 6)
+            if  "next" not in data["links"]:
+                break
+            page += 1
+        print(f"Subject {subject_code} completed")
+
+        with writer() as conn:
             cursor = conn.cursor()
-            page = 0
-            while True:
-                data = self.fetch_variables_page(subject_code, page, lang)
-                if not data:
-                    time.sleep(5)
-                    continue
-                
-                for item in data["results"]:
-                    if int(item["level"]) == 6 :
-                        self.add_variable(cursor, item,lang)
-                if  "next" not in data["links"]:
-                    break
-                page += 1
-                time.sleep(1 / REQUESTS_PER_SECOND_LIMIT)
-            print(f"Subject {subject_code} completed")
+            for item in items:
+                self.add_variable(cursor, item,lang)
             Subjects().mark_parent_fetched(cursor, subject_code, lang)
 
-            conn.commit()
-
     def fetch_and_save_variables_for_subjects(self, lang):
         while True:
             subject_code = self.get_pending_subject_with_variables(lang)
@@ -133,13 +187,13 @@ class Variables(object):
             self.fetch_and_save_variables(subject_code, lang)
 
     def recreate_variables_table(self):
-        with sqlite3.connect(DB_PATH) as conn:
+        with writer() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 DROP TABLE IF EXISTS variables;
             ''')
-            conn.commit()
-        self.__init__()
+        with writer() as conn:
+            create_variables(conn)
         self.fetch_and_save_variables_for_subjects("pl")
         self.fetch_and_save_variables_for_subjects("en")
 
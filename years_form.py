@@ -11,41 +11,78 @@
 __author__ = 'Wawrzyniec Zipser, Maciej Kamiński Politechnika Wrocławska'
 
 import os
-from PyQt5.QtWidgets import QDialog, QVBoxLayout, QPushButton, QListWidget, QListWidgetItem
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QPushButton, QListWidget, QListWidgetItem, QLabel, QProgressBar
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
 from datetime import datetime
-from .utils.translations import _
+from .utils.translations import _, gus_language
+from .utils.variables import Variables
+
+# Workers of closed dialogs, kept until their threads end, a QThread must not be deleted while running
+RUNNING_WORKERS = set()
+
+class YearsWorker(QThread):
+    """
+    Collects the years with data for the selected variables in the background,
+    each variable may need a request to the API.
+    """
+    progress_updated = pyqtSignal(int)  # Signal with the number of variables checked
+    years_loaded = pyqtSignal(list)  # Signal with the sorted available years
+
+    def __init__(self, variables):
+        super().__init__()
+        self.variables = variables
+
+    def run(self):
+        available_years = set()
+        variables = Variables()
+        for i, variable in enumerate(self.variables, start=1):
+            if self.isInterruptionRequested():
+                return
+            available_years.update(variables.available_years(variable, gus_language))
+            self.progress_updated.emit(i)
+        self.years_loaded.emit(sorted(available_years))
+
 
 class YearsForm(QDialog):
     """
     Dialog for selecting years from a predefined list with checkboxes.
     Allows the user to select multiple years and validates the selection.
     """
-    def __init__(self, years):
+    def __init__(self, variables):
         """
         Initializes the dialog.
 
         Args:
-            years (list): List of available years for selection.
+            variables (list): IDs of the selected variables, the years with data for them are listed.
         """
         super().__init__()
-        self.years = years  # List of all available years
+        self.variables = variables
+        self.years = None  # List of all available years, loaded when the dialog is shown
         self.selected_years = []  # List of selected years
+        self.worker = None
 
         # Main window settings
         self.setWindowTitle(_("Select Years"))
         self.resize(400, 300)
 
+        # Status and progress of loading the years
+        self.status_label = QLabel(_("Checking years with data..."))
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, len(variables))
+
         # List widget for displaying years with checkboxes
         self.year_list = QListWidget()
+        self.year_list.setEnabled(False)
 
         # "Next" button to proceed
-        self.next_button = QPushButton(_("Add Layer to Map"))
+        self.next_button = QPushButton(_("Next"))
         self.next_button.setEnabled(False)  # Initially disabled until a year is selected
         self.next_button.clicked.connect(self.accept)
 
         # Main layout
         layout = QVBoxLayout()
+        layout.addWidget(self.status_label)
+        layout.addWidget(self.progress_bar)
         layout.addWidget(self.year_list)
         layout.addWidget(self.next_button)
         self.setLayout(layout)
@@ -78,8 +115,32 @@ class YearsForm(QDialog):
     def showEvent(self, event):
         """
         Triggered when the dialog is shown.
-        Ensures the year list is populated.
+        Starts loading the years, the list is populated when they are known.
+        """
+        super().showEvent(event)
+        if self.years is None and self.worker is None:
+            self.worker = YearsWorker(self.variables)
+            self.worker.progress_updated.connect(self.progress_bar.setValue)
+            self.worker.years_loaded.connect(self.on_years_loaded)
+            RUNNING_WORKERS.add(self.worker)
+            self.worker.finished.connect(lambda worker=self.worker: RUNNING_WORKERS.discard(worker))
+            self.worker.start()
+
+    def on_years_loaded(self, years):
+        """
+        Shows the loaded years in the list.
+
+        Args:
+            years (list): Sorted years with data for the selected variables.
         """
+        self.years = years
+        self.progress_bar.hide()
+        if not years:
+            # neither the years of the variables nor the list of all years could be fetched
+            self.status_label.setText(_("Could not load the years with data. Check the connection and try again."))
+            return
+        self.status_label.hide()
+        self.year_list.setEnabled(True)
         self.populate_years()
 
     def on_item_changed(self, item):
@@ -107,6 +168,15 @@ class YearsForm(QDialog):
         """
         self.next_button.setEnabled(len(self.selected_years) > 0)
 
+    def reject(self):
+        """
+        Stops loading the years when the dialog is closed. The dialog does not wait for
+        the worker, it ends after the request in progress.
+        """
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.requestInterruption()
+        super().reject()
+
     def closeEvent(self, event):
         """
         Handles the close event for the dialog.